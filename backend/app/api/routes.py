@@ -1,22 +1,59 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Header, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from typing import List, Optional
-import time
+import asyncio
+import json
+import os
 
 from app.models import (
-    Document, QueryRequest, QueryResponse, Citation, HealthResponse
+    BatchQueryRequest, Document, IngestionJob, QueryRequest, QueryResponse, Citation, HealthResponse
 )
 from app.services.storage import vector_store
-from app.services.llm import get_embedding, generate_answer, check_connection
-from app.utils import clean_text, chunk_text
+from app.services.cache import answer_cache, normalize_text, query_embedding_cache
+from app.core.config import get_settings
+from app.core import metrics
+from app.core.metrics import timed
+from app.services.jobs import IngestionTask, ingestion_queue
+from app.services.llm import (
+    get_query_embedding, get_query_embeddings, generate_answer, stream_answer, gemini_breaker, inflight_stats
+)
+from app.services.circuit import CircuitOpenError
+from app.services.context import pack_context
+from app.services.health import health_prober
+
+settings = get_settings()
 
 router = APIRouter()
 
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
 async def get_session_id(x_session_id: Optional[str] = Header(None)):
     if not x_session_id:
         raise HTTPException(status_code=400, detail="X-Session-ID header is required")
     return x_session_id
 
-@router.post("/upload", response_model=Document)
+def _spool_upload(file: UploadFile, path: str):
+    """Copies the request body to our own file so a worker can read it after the response."""
+    total = 0
+    with open(path, 'wb') as out:
+        while True:
+            block = file.file.read(64 * 1024)
+            if not block:
+                return
+            total += len(block)
+            if total > MAX_UPLOAD_BYTES:
+                raise ValueError("File too large (Max 10MB)")
+            out.write(block)
+
+def _queue_full() -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Too many uploads in progress, please retry later",
+        headers={"Retry-After": str(settings.INGEST_RETRY_AFTER_SECONDS)}
+    )
+
+@router.post("/upload", response_model=IngestionJob, status_code=202)
 async def upload_file(
     file: UploadFile = File(...), 
     session_id: str = Depends(get_session_id)
@@ -25,75 +62,56 @@ async def upload_file(
     if not file.filename.endswith(".txt"):
         raise HTTPException(status_code=400, detail="Only .txt files are allowed")
     
-    # Read content
-    content_bytes = await file.read()
-    
-    # Check size (10MB limit)
-    if len(content_bytes) > 10 * 1024 * 1024:
+    # Check size (10MB limit) up front when the client sent it; spooling enforces it too
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
         raise HTTPException(status_code=400, detail="File too large (Max 10MB)")
-        
-    try:
-        text = content_bytes.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="File must be valid UTF-8 text")
-        
-    # Check null bytes
-    if '\0' in text:
-        raise HTTPException(status_code=400, detail="File contains null bytes (binary file?)")
-        
-    # 2. Processing
-    clean_txt = clean_text(text)
-    if not clean_txt:
-        raise HTTPException(status_code=400, detail="File is empty")
-        
-    chunks = chunk_text(clean_txt)
     
-    # 3. Embedding & Storing
-    doc_id = str(int(time.time())) # Simple ID
-    
-    for i, chunk in enumerate(chunks):
-        # Embed
-        vector = get_embedding(chunk)
-        
-        # Store with session_id
-        vector_store.add(
-            text=chunk,
-            vector=vector,
-            source=file.filename,
-            session_id=session_id
-        )
+    # Fail fast before spooling the body; submit() re-checks after
+    if ingestion_queue.queue.full():
+        raise _queue_full()
         
-    return Document(
-        id=doc_id,
+    # 2. Hand off to the ingestion workers; chunking and embedding happen in the background
+    task = IngestionTask(
+        session_id=session_id,
         filename=file.filename,
-        upload_date=time.strftime("%Y-%m-%d %H:%M:%S"),
-        chunk_count=len(chunks)
+        upload_dir=os.path.join(settings.STORAGE_DIR, "uploads")
     )
-
-@router.post("/query", response_model=QueryResponse)
-async def query_documents(
-    request: QueryRequest, 
-    session_id: str = Depends(get_session_id)
-):
-    # 1. Embed Query
-    query_vec = get_embedding(request.question)
-    
-    # 2. Search (Isolated by session_id)
-    results = vector_store.search(query_vec, session_id=session_id, k=request.k)
-    
-    # 3. Generate Answer
-    if not results:
-        return QueryResponse(answer="No relevant documents found in your session.", citations=[])
-        
-    context_chunks = [res["doc"]["text"] for res in results]
     
     try:
-        answer = generate_answer(request.question, context_chunks)
-    except Exception as e:
-        answer = "I encountered an error generating the answer."
-        print(f"LLM Error: {e}")
+        with timed("upload", "spool"):
+            await run_in_threadpool(_spool_upload, file, task.path)
+        await ingestion_queue.submit(task)
+    except ValueError as e:
+        os.remove(task.path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except asyncio.QueueFull:
+        os.remove(task.path)
+        raise _queue_full()
+        
+    return task.to_model()
 
-    # 4. Format Citations
+@router.get("/jobs/{job_id}", response_model=IngestionJob)
+async def get_job(job_id: str, session_id: str = Depends(get_session_id)):
+    job = await ingestion_queue.get(job_id, session_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+NO_RESULTS_ANSWER = "No relevant documents found in your session."
+
+def _retrieval_mode(request) -> str:
+    return request.mode or settings.RETRIEVAL_MODE
+
+def _answer_cache_key(question: str, mode: str, results: List[dict]) -> tuple:
+    # The cached citations carry the scores of the mode that retrieved them
+    return (
+        settings.CHAT_MODEL,
+        mode,
+        normalize_text(question),
+        tuple(res["doc"]["id"] for res in results)
+    )
+
+def _format_citations(results: List[dict]) -> List[Citation]:
     citations = []
     for res in results:
         doc = res["doc"]
@@ -104,27 +122,204 @@ async def query_documents(
             chunk_id=doc["id"],
             score=score
         ))
+    return citations
+
+async def _retrieve(request: QueryRequest, session_id: str, route: str) -> List[dict]:
+    mode = _retrieval_mode(request)
+    if mode == "lexical":
+        with timed(route, "search"):
+            return await run_in_threadpool(
+                vector_store.lexical_search, request.question, session_id=session_id, k=request.k
+            )
+
+    # 1. Embed Query
+    with timed(route, "embed"):
+        query_vec = await get_query_embedding(request.question)
+    
+    # 2. Search (Isolated by session_id); shards are locked per session, so this runs off the event loop
+    with timed(route, "search"):
+        if mode == "hybrid":
+            return await run_in_threadpool(
+                vector_store.hybrid_search, request.question, query_vec, session_id=session_id, k=request.k
+            )
+        return await run_in_threadpool(vector_store.search, query_vec, session_id=session_id, k=request.k)
+
+def _pack(results: List[dict], route: str) -> dict:
+    """Context assembly between retrieval and generation; see pack_context."""
+    with timed(route, "pack"):
+        packed = pack_context(results, settings.CONTEXT_TOKEN_BUDGET, settings.CONTEXT_DEDUP_THRESHOLD)
+    metrics.CONTEXT_TOKENS.observe(packed["tokens_before"], stage="retrieved")
+    metrics.CONTEXT_TOKENS.observe(packed["tokens_after"], stage="packed")
+    return packed
+
+def _json_response(model) -> Response:
+    """Serializes here rather than in FastAPI, so serialization shows up as its own stage."""
+    with timed("query", "serialize"):
+        return Response(content=model.model_dump_json(), media_type="application/json")
+
+async def _answer(question: str, mode: str, results: List[dict], session_id: str, route: str) -> QueryResponse:
+    # 3. Generate Answer
+    if not results:
+        return QueryResponse(answer=NO_RESULTS_ANSWER, citations=[])
         
-    return QueryResponse(answer=answer, citations=citations)
+    cache_key = _answer_cache_key(question, mode, results)
+    cached = answer_cache.get(session_id, cache_key)
+    if cached is not None:
+        return cached
+
+    packed = _pack(results, route)
+    
+    answer_ok = True
+    try:
+        with timed(route, "generate"):
+            answer = await generate_answer(question, packed["chunks"])
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        answer = "I encountered an error generating the answer."
+        answer_ok = False
+        print(f"LLM Error: {e}")
+
+    # 4. Format Citations
+    # Only chunks that made it into the prompt are cited
+    response = QueryResponse(answer=answer, citations=_format_citations(packed["results"]))
+    if answer_ok:
+        answer_cache.set(session_id, cache_key, response)
+    return response
+
+@router.post("/query", response_model=QueryResponse)
+async def query_documents(
+    request: QueryRequest, 
+    session_id: str = Depends(get_session_id)
+):
+    results = await _retrieve(request, session_id, "query")
+    return _json_response(await _answer(request.question, _retrieval_mode(request), results, session_id, "query"))
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/query/stream")
+async def stream_query(
+    request: QueryRequest,
+    session_id: str = Depends(get_session_id)
+):
+    """
+    Server-Sent Events version of /query. Emits one `citations` event as soon as
+    retrieval finishes, then `token` events as the answer is generated, then `done`.
+    """
+    results = await _retrieve(request, session_id, "query_stream")
+    packed = _pack(results, "query_stream") if results else None
+    citations = _format_citations(packed["results"]) if packed else []
+
+    async def events():
+        yield _sse("citations", [c.model_dump() for c in citations])
+
+        if not results:
+            yield _sse("token", {"text": NO_RESULTS_ANSWER})
+            yield _sse("done", {})
+            return
+
+        cache_key = _answer_cache_key(request.question, _retrieval_mode(request), results)
+        cached = answer_cache.get(session_id, cache_key)
+        if cached is not None:
+            yield _sse("token", {"text": cached.answer})
+            yield _sse("done", {})
+            return
+
+        parts = []
+        try:
+            # Runs after the headers went out, so this stage is in the histogram only
+            with timed("query_stream", "generate"):
+                async for text in stream_answer(request.question, packed["chunks"]):
+                    parts.append(text)
+                    yield _sse("token", {"text": text})
+        except CircuitOpenError as e:
+            yield _sse("error", {"detail": str(e)})
+            return
+        except Exception as e:
+            print(f"LLM Error: {e}")
+            yield _sse("error", {"detail": "I encountered an error generating the answer."})
+            return
+
+        answer_cache.set(session_id, cache_key, QueryResponse(answer="".join(parts), citations=citations))
+        yield _sse("done", {})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _lexical_search_many(questions: List[str], session_id: str, k: int) -> List[List[dict]]:
+    return [vector_store.lexical_search(question, session_id=session_id, k=k) for question in questions]
+
+async def _retrieve_many(request: BatchQueryRequest, session_id: str) -> List[List[dict]]:
+    mode = _retrieval_mode(request)
+    if mode == "lexical":
+        with timed("query_batch", "search"):
+            return await run_in_threadpool(_lexical_search_many, request.questions, session_id, request.k)
+
+    with timed("query_batch", "embed"):
+        query_vecs = await get_query_embeddings(request.questions)
+
+    with timed("query_batch", "search"):
+        if mode == "hybrid":
+            return await run_in_threadpool(
+                vector_store.hybrid_search_many, request.questions, query_vecs, session_id=session_id, k=request.k
+            )
+        return await run_in_threadpool(vector_store.search_many, query_vecs, session_id=session_id, k=request.k)
+
+@router.post("/query/batch")
+async def batch_query(
+    request: BatchQueryRequest,
+    session_id: str = Depends(get_session_id)
+):
+    """
+    Many questions against one session. All questions are embedded in batched calls
+    and retrieved together in one matrix product; answers are generated at most
+    BATCH_QUERY_CONCURRENCY at a time. Server-Sent Events: one `result` event per
+    question ({"index", "question", "answer", "citations"}) in the order the answers
+    complete, or an `error` event for questions that could not be answered, then `done`.
+    """
+    if len(request.questions) > settings.BATCH_QUERY_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many questions (Max {settings.BATCH_QUERY_MAX_QUESTIONS} per batch)"
+        )
+    results = await _retrieve_many(request, session_id)
+    limiter = asyncio.Semaphore(settings.BATCH_QUERY_CONCURRENCY)
+
+    async def answer(index: int) -> tuple:
+        question = request.questions[index]
+        async with limiter:
+            try:
+                response = await _answer(question, _retrieval_mode(request), results[index], session_id, "query_batch")
+            except CircuitOpenError as e:
+                return "error", {"index": index, "question": question, "detail": str(e)}
+        return "result", {"index": index, "question": question, **response.model_dump()}
+
+    async def events():
+        tasks = [asyncio.ensure_future(answer(index)) for index in range(len(request.questions))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                event, data = await next_done
+                yield _sse(event, data)
+            yield _sse("done", {})
+        finally:
+            # The client went away: stop generating answers nobody will read
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.get("/documents", response_model=List[Document])
 async def list_documents(session_id: str = Depends(get_session_id)):
-    unique_docs = {}
-    # Filter documents by session_id before aggregating
-    user_docs = [doc for doc in vector_store.documents if doc.get("session_id") == session_id]
-    
-    for doc in user_docs:
-        source = doc["source"]
-        if source not in unique_docs:
-            unique_docs[source] = {
-                "id": source, 
-                "filename": source,
-                "upload_date": "Recent",
-                "chunk_count": 0
-            }
-        unique_docs[source]["chunk_count"] += 1
-        
-    return list(unique_docs.values())
+    documents = await run_in_threadpool(vector_store.list_documents, session_id)
+    return [Document(**document) for document in documents]
 
 @router.delete("/documents/{file_id}")
 async def delete_document(
@@ -132,19 +327,58 @@ async def delete_document(
     session_id: str = Depends(get_session_id)
 ):
     # Pass session_id to ensure the user owns the document they are deleting
-    success = vector_store.delete_document(file_id, session_id=session_id)
+    success = await run_in_threadpool(vector_store.delete_document, file_id, session_id=session_id)
     if not success:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
     return {"message": "Document deleted successfully"}
 
 @router.get("/health", response_model=HealthResponse)
 async def health_check():
-    backend_status = "ok"
-    storage_status = "ok" if vector_store else "error"
-    llm_status = "ok" if check_connection() else "error"
-    
-    return HealthResponse(
-        backend=backend_status,
-        storage=storage_status,
-        gemini=llm_status
-    )
+    # Served from the background prober; never calls Gemini itself
+    return HealthResponse(**health_prober.status())
+
+@router.get("/stats")
+async def get_stats():
+    """Cache and request-coalescing counters, for monitoring."""
+    return {
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "in_flight": inflight_stats(),
+        "gemini_circuit": gemini_breaker.stats(),
+        "store": await run_in_threadpool(vector_store.residency_stats)
+    }
+
+def _collect_gauges():
+    caches = {"query_embedding": query_embedding_cache.stats(), "answer": answer_cache.stats()}
+    for cache, stats in caches.items():
+        for result in ("hits", "disk_hits", "misses"):
+            if result in stats:
+                metrics.CACHE_LOOKUPS.set(stats[result], cache=cache, result=result)
+        metrics.CACHE_HIT_RATIO.set(stats["hit_rate"], cache=cache)
+        metrics.CACHE_ENTRIES.set(stats["size"], cache=cache)
+    for call, stats in inflight_stats().items():
+        metrics.COALESCED_CALLS.set(stats["calls_coalesced"], call=call)
+    metrics.INGEST_QUEUE_DEPTH.set(ingestion_queue.queue.qsize())
+    breaker = gemini_breaker.stats()
+    metrics.GEMINI_CIRCUIT_OPEN.set(1 if breaker["state"] == "open" else 0)
+    metrics.GEMINI_CIRCUIT_REJECTED.set(breaker["rejected"])
+
+    residency = vector_store.residency_stats()
+    metrics.RESIDENT_SESSIONS.set(residency["resident_sessions"])
+    metrics.RESIDENT_BYTES.set(residency["resident_bytes"])
+    metrics.MEMORY_BUDGET_BYTES.set(residency["memory_budget_bytes"])
+
+    # Sessions come and go, so their series are rebuilt on every scrape
+    sessions = vector_store.session_stats()
+    for gauge in (metrics.SESSION_CHUNKS, metrics.SESSION_TOMBSTONES, metrics.SESSION_VECTOR_BYTES):
+        gauge.clear()
+    for shard, stats in sessions.items():
+        metrics.SESSION_CHUNKS.set(stats["chunks"], shard=shard)
+        metrics.SESSION_TOMBSTONES.set(stats["tombstoned_chunks"], shard=shard)
+        metrics.SESSION_VECTOR_BYTES.set(stats["vector_bytes"], shard=shard)
+
+@router.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition: stage latency histograms, retries, cache hit rates, store size."""
+    await run_in_threadpool(_collect_gauges)  # reads shard sizes under their locks
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 
 # Get the directory where this config file is located: backend/app/core/config.py
 # .parent -> backend/app/core
@@ -14,11 +15,58 @@ class Settings(BaseSettings):
     ALLOWED_ORIGINS: str = "http://localhost:5173"
     
     # Storage
-    STORAGE_FILE: str = "storage.json"
+    STORAGE_DIR: str = "storage"
+    STORAGE_FILE: str = "storage.json"  # legacy format, migrated into STORAGE_DIR on first start
+    VECTOR_ENCODING: str = "float32"  # float32 | float16 | int8 (codes held in RAM)
+    RESCORE_FACTOR: int = 4  # compact encodings rescore k * RESCORE_FACTOR candidates exactly
+    COMPACTION_THRESHOLD: float = 0.25  # tombstoned fraction of rows that triggers a rewrite
+    COMPACTION_INTERVAL_SECONDS: int = 30
+    STORAGE_LOCK_TIMEOUT_SECONDS: float = 30  # wait for another worker's write to finish
+    STORE_MEMORY_BUDGET_MB: int = 1024  # per worker; least recently used sessions are evicted past it (0 = no limit)
+    STORAGE_DB_CONNECTIONS: int = 4  # pooled SQLite connections per session shard (and store.db), per worker
     
     # Model Config
     EMBEDDING_MODEL: str = "gemini-embedding-001"
+    EMBEDDING_DIMENSION: Optional[int] = None  # output_dimensionality, e.g. 768 or 1536; None = model default (3072)
     CHAT_MODEL: str = "gemini-flash-latest"
+    EMBEDDING_BATCH_SIZE: int = 100  # contents per embed_content request (API max is 100)
+    EMBEDDING_CONCURRENCY: int = 4   # batch requests in flight during an upload
+    GEMINI_MAX_CONCURRENCY: int = 8  # Gemini requests in flight across the process
+    GEMINI_BREAKER_FAILURES: int = 5  # 429/5xx responses in a row that open the circuit
+    GEMINI_BREAKER_RESET_SECONDS: float = 30  # fail fast this long, then let one call test recovery
+    HEALTH_CHECK_INTERVAL_SECONDS: float = 30  # background Gemini/storage probe; /api/health serves the result
+
+    # Background ingestion
+    INGEST_WORKERS: int = 2
+    INGEST_QUEUE_SIZE: int = 16  # queued uploads before /upload answers 429
+    INGEST_RETRY_AFTER_SECONDS: int = 30
+    INGEST_JOB_RETENTION_SECONDS: int = 3600  # how long finished job status stays queryable
+    INGEST_JOB_HEARTBEAT_SECONDS: int = 30  # unfinished jobs not refreshed for 3 beats (worker restarted) fail
+
+    # Approximate search (IVF) for large sessions; smaller ones are scanned exactly
+    ANN_ENABLED: bool = True
+    ANN_MIN_SIZE: int = 5000
+    ANN_NPROBE: int = 16  # lists scanned per query: higher = better recall, slower
+
+    # Retrieval: "vector", "lexical" (BM25 only, no query embedding) or "hybrid" (both, fused by RRF).
+    # The frontend shows citation scores as a % match, which only holds for "vector"
+    RETRIEVAL_MODE: str = "vector"
+    HYBRID_CANDIDATE_FACTOR: int = 4  # each ranking contributes k * factor candidates
+    RRF_K: int = 60
+
+    # Context packing: retrieved chunks are de-duplicated, merged and trimmed before generation
+    CONTEXT_TOKEN_BUDGET: int = 2000  # estimated tokens of context per prompt; the best passage always goes in
+    CONTEXT_DEDUP_THRESHOLD: float = 0.9  # word-trigram Jaccard similarity that makes a chunk a near-duplicate
+
+    # Batch queries (/api/query/batch)
+    BATCH_QUERY_MAX_QUESTIONS: int = 500
+    BATCH_QUERY_CONCURRENCY: int = 4  # answers generated at once per batch; GEMINI_MAX_CONCURRENCY still applies
+
+    # Caching
+    QUERY_EMBEDDING_CACHE_SIZE: int = 1024
+    QUERY_EMBEDDING_CACHE_FILE: str = ""  # e.g. "query_cache.db" to keep embeddings across restarts
+    ANSWER_CACHE_SIZE: int = 512
+    ANSWER_CACHE_TTL_SECONDS: int = 3600
 
     # Use model_config for Pydantic v2
     model_config = {
@@ -0,0 +1,219 @@
+"""
+In-process metrics in the Prometheus text format, without a client library.
+Counters and histograms are updated as work happens; gauges are set just before
+each scrape. Every worker process keeps its own numbers, so with gunicorn -w N
+each scrape sees one worker.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; from a cache hit up to a long generate_answer or a large commit
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return lines + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in items]
+
+class Gauge(Counter):
+    """Set at scrape time from whatever owns the number; clear() drops label sets that went away."""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.series: Dict[Tuple[str, ...], list] = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self.series.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(self.labelnames, key, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    "qa_request_duration_seconds", "HTTP request latency, until the response headers", ["route", "method", "status"]
+)
+STAGE_SECONDS = registry.histogram(
+    "qa_stage_duration_seconds", "Latency of each stage of a request or ingestion job", ["route", "stage"]
+)
+STORE_SECONDS = registry.histogram(
+    "qa_store_operation_duration_seconds", "Vector store load, commit, catch-up, delete and compaction", ["operation"]
+)
+CONTEXT_TOKENS = registry.histogram(
+    "qa_context_tokens", "Estimated prompt tokens of retrieved context per question, before and after packing",
+    ["stage"], buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+)
+SESSION_PAGE_INS = registry.counter("qa_store_session_page_ins_total", "Session shards loaded into memory")
+SESSION_EVICTIONS = registry.counter(
+    "qa_store_session_evictions_total", "Session shards dropped from memory to stay within the memory budget"
+)
+GEMINI_RETRIES = registry.counter("qa_gemini_retries_total", "Gemini calls retried after a rate limit", ["call"])
+GEMINI_ERRORS = registry.counter("qa_gemini_errors_total", "Gemini calls that failed after all retries", ["call"])
+
+# Gauges, read from their owners at scrape time
+CACHE_LOOKUPS = registry.gauge("qa_cache_lookups", "Cache lookups since start, by result", ["cache", "result"])
+CACHE_HIT_RATIO = registry.gauge("qa_cache_hit_ratio", "Share of cache lookups that hit", ["cache"])
+CACHE_ENTRIES = registry.gauge("qa_cache_entries", "Entries currently held in memory", ["cache"])
+COALESCED_CALLS = registry.gauge("qa_coalesced_calls", "Calls that joined an identical call in flight", ["call"])
+GEMINI_CIRCUIT_OPEN = registry.gauge("qa_gemini_circuit_open", "1 while the Gemini circuit breaker is open")
+GEMINI_CIRCUIT_REJECTED = registry.gauge(
+    "qa_gemini_circuit_rejected_calls", "Gemini calls failed fast by the circuit breaker since start"
+)
+INGEST_QUEUE_DEPTH = registry.gauge("qa_ingest_queue_depth", "Uploads waiting for an ingestion worker")
+RESIDENT_SESSIONS = registry.gauge("qa_store_resident_sessions", "Session shards currently in memory")
+RESIDENT_BYTES = registry.gauge("qa_store_resident_bytes", "Estimated memory held by resident session shards")
+MEMORY_BUDGET_BYTES = registry.gauge("qa_store_memory_budget_bytes", "STORE_MEMORY_BUDGET_MB in bytes (0 = no limit)")
+SESSION_CHUNKS = registry.gauge(
+    "qa_store_session_chunks", "Searchable chunks per resident session shard, by shard directory", ["shard"]
+)
+SESSION_TOMBSTONES = registry.gauge(
+    "qa_store_session_tombstoned_chunks", "Deleted chunks awaiting compaction per session shard", ["shard"]
+)
+SESSION_VECTOR_BYTES = registry.gauge(
+    "qa_store_session_vector_bytes", "Vector segment bytes per session shard", ["shard"]
+)
+
+# Stages timed during the current request, reported in its Server-Timing header
+_request_stages: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_stages", default=None)
+
+def start_request_timing() -> List[Tuple[str, float]]:
+    """Starts collecting stage timings for the current request; timed() appends to the list."""
+    stages: List[Tuple[str, float]] = []
+    _request_stages.set(stages)
+    return stages
+
+@contextmanager
+def timed(route: str, stage: str):
+    """Records one stage in STAGE_SECONDS and, inside a request, its Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, route=route, stage=stage)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages.append((stage, elapsed))
+
+def server_timing(stages: List[Tuple[str, float]], total: float) -> str:
+    """Server-Timing header value, durations in milliseconds."""
+    entries = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in stages]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
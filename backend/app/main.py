@@ -1,11 +1,31 @@
-from fastapi import FastAPI
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import get_settings
+from app.core.metrics import REQUEST_SECONDS, server_timing, start_request_timing
 from app.api.routes import router
+from app.services.cache import answer_cache
+from app.services.circuit import CircuitOpenError
+from app.services.health import health_prober
+from app.services.jobs import ingestion_queue
+from app.services.storage import EmbeddingSpaceError, vector_store
 
 settings = get_settings()
 
-app = FastAPI(title=settings.APP_NAME)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ingestion_queue.start()
+    compactor = asyncio.create_task(vector_store.run_compactor())
+    prober = asyncio.create_task(health_prober.run())
+    yield
+    prober.cancel()
+    compactor.cancel()
+    await ingestion_queue.stop()
+
+app = FastAPI(title=settings.APP_NAME, lifespan=lifespan)
 
 # CORS
 origins = [o.strip() for o in settings.ALLOWED_ORIGINS.split(",")]
@@ -20,6 +40,37 @@ app.add_middleware(
 
 app.include_router(router, prefix="/api")
 
+@app.exception_handler(CircuitOpenError)
+async def gemini_unavailable(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(EmbeddingSpaceError)
+async def embedding_space_mismatch(request: Request, exc: EmbeddingSpaceError):
+    # Until python -m app.reindex has moved the session to the configured model/dimension
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+@app.middleware("http")
+async def record_timing(request: Request, call_next):
+    """Request latency histogram, plus a Server-Timing header with the stages timed so far."""
+    stages = start_request_timing()
+    start = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - start
+    # The route template, not the raw path, so job ids don't become label values
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(
+        total, route=getattr(route, "path", "unmatched"), method=request.method, status=response.status_code
+    )
+    response.headers["Server-Timing"] = server_timing(stages, total)
+    return response
+
+# Cached answers are only valid for the corpus they were generated from
+vector_store.add_listener(answer_cache.invalidate_session)
+
 @app.get("/")
 async def root():
     return {"message": "Private Knowledge Q&A API is likely running. Check /docs for swagger."}
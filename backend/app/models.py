@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+from pydantic import BaseModel, Field
+from typing import List, Dict, Literal, Optional
 
 class Document(BaseModel):
     id: str
@@ -7,15 +7,31 @@ class Document(BaseModel):
     upload_date: str
     chunk_count: int
 
+class IngestionJob(BaseModel):
+    id: str
+    filename: str
+    status: str  # queued | processing | completed | failed
+    chunks_processed: int
+    chunks_total: Optional[int] = None
+    chunks_reused: int = 0  # unchanged from the previous version of the file, not embedded again
+    document: Optional[Document] = None
+    error: Optional[str] = None
+
 class Citation(BaseModel):
     source_file: str
     text_snippet: str
     chunk_id: int
-    score: float
+    score: float  # "vector": cosine similarity; "lexical": BM25 (unbounded); "hybrid": RRF (at most ~0.03)
 
 class QueryRequest(BaseModel):
     question: str
     k: int = 3
+    mode: Optional[Literal["vector", "lexical", "hybrid"]] = None  # defaults to RETRIEVAL_MODE
+
+class BatchQueryRequest(BaseModel):
+    questions: List[str] = Field(..., min_length=1)
+    k: int = 3
+    mode: Optional[Literal["vector", "lexical", "hybrid"]] = None
 
 class QueryResponse(BaseModel):
     answer: str
@@ -25,3 +41,5 @@ class HealthResponse(BaseModel):
     backend: str
     storage: str
     gemini: str
+    gemini_circuit: str = "closed"  # closed | open | half_open
+    checked_at: Optional[float] = None  # Unix time of the background probe reported here
@@ -0,0 +1,167 @@
+"""
+Moves the vector store into another embedding space: a different EMBEDDING_MODEL
+and/or EMBEDDING_DIMENSION. Queries never score across spaces, so a session not
+yet re-indexed answers 503 until it is; run this with the server stopped, or
+expect that for the sessions still pending.
+
+Usage (from backend/):
+    python -m app.reindex --dimension 768 --truncate
+    python -m app.reindex --model gemini-embedding-001 --dimension 1536
+
+--truncate keeps the model and cuts the stored vectors down to their first
+--dimension components, renormalized; gemini-embedding-001 is trained so that
+prefixes are embeddings in their own right, and no API calls are made. Otherwise
+every live chunk is embedded again. Sessions are processed --parallel at a time
+and each one checkpoints after every batch, so an interrupted run resumes where
+it stopped; sessions already in the target space are skipped. Without --dimension
+the target is the model's default, found by embedding one probe text. Afterwards set
+EMBEDDING_MODEL and EMBEDDING_DIMENSION to match and restart the server.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+from typing import Optional
+
+import numpy as np
+
+from app.core.config import get_settings
+from app.services.llm import get_embeddings
+from app.services.quantization import normalize
+from app.services.storage import SHARD_SCHEMA, SessionShard, _Database, vector_store
+
+settings = get_settings()
+
+def _spool_paths(shard: SessionShard, model: str, dimension: Optional[int]) -> tuple:
+    name = f"reindex-{model.replace('/', '_')}-{dimension or 'default'}"
+    return os.path.join(shard.directory, name + ".f32"), os.path.join(shard.directory, name + ".json")
+
+def _checkpoint(path: str, state: dict):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def _truncate(shard: SessionShard, dimension: int, rows: int, generation: int):
+    vectors = np.fromfile(
+        os.path.join(shard.directory, f"vectors-{generation}.f32"), dtype=np.float32, count=rows * shard.dim
+    ).reshape(rows, shard.dim)
+    shard.replace_vectors(normalize(vectors[:, :dimension]), shard.embedding_model, rows, generation)
+
+async def _reembed(shard: SessionShard, model: str, dimension: Optional[int], target_dim: int,
+                   rows: int, generation: int):
+    """Embeds every live row into a spool file, checkpointing after each window, then swaps it in."""
+    spool_path, state_path = _spool_paths(shard, model, dimension)
+    state = {"rows": rows, "generation": generation, "done": 0, "dim": target_dim}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            saved = json.load(f)
+        if (saved["rows"], saved["generation"], saved["dim"]) == (rows, generation, target_dim):
+            state = saved
+
+    window = settings.EMBEDDING_BATCH_SIZE * settings.EMBEDDING_CONCURRENCY
+    with open(spool_path, 'ab') as spool:
+        # Drop anything written after the last checkpoint
+        spool.truncate(state["done"] * state["dim"] * 4)
+        while state["done"] < rows:
+            start, stop = state["done"], min(state["done"] + window, rows)
+            with shard.meta.connection() as db:
+                live = [
+                    (position, text) for position, text in db.execute(
+                        "SELECT position, text FROM chunks WHERE position >= ? AND position < ? ORDER BY position",
+                        (start, stop)
+                    )
+                    if position not in shard.tombstones
+                ]
+            embeddings = await get_embeddings([text for _, text in live], model=model, dimension=dimension)
+            if embeddings and len(embeddings[0]) != state["dim"]:
+                raise RuntimeError(f"{model} returned {len(embeddings[0])} dimensions, expected {state['dim']}")
+            # Tombstoned rows are never searched again, so they keep zero vectors until compaction
+            block = np.zeros((stop - start, state["dim"]), dtype=np.float32)
+            for (position, _), embedding in zip(live, embeddings):
+                block[position - start] = embedding
+            spool.write(block.tobytes())
+            spool.flush()
+            os.fsync(spool.fileno())
+            state["done"] = stop
+            _checkpoint(state_path, state)
+
+    vectors = np.fromfile(spool_path, dtype=np.float32, count=rows * state["dim"]).reshape(rows, state["dim"])
+    await asyncio.to_thread(shard.replace_vectors, vectors, model, rows, generation)
+    os.remove(spool_path)
+    os.remove(state_path)
+
+async def target_dimension(args) -> int:
+    """The dimension vectors will have: --dimension, or the model's default, asked of the model once."""
+    if args.dimension:
+        return args.dimension
+    return len((await get_embeddings(["dimension probe"], model=args.model))[0])
+
+async def reindex_shard(path: str, args, target_dim: int) -> str:
+    session_key = os.path.basename(os.path.dirname(path))
+    meta = _Database(path, SHARD_SCHEMA)
+    session_id = meta.get_state("session_id")
+    meta.close()
+    if session_id is None:
+        return f"{session_key}: skipped, not initialized"
+    shard = await asyncio.to_thread(
+        SessionShard, os.path.dirname(path), session_id, settings.VECTOR_ENCODING, lambda _: None
+    )
+    try:
+        return await _reindex(shard, session_key, args, target_dim)
+    finally:
+        shard.close()
+
+async def _reindex(shard: SessionShard, session_key: str, args, target_dim: int) -> str:
+    rows, generation = shard.meta.get_state("rows", 0), shard.generation
+    current = f"{shard.embedding_model} ({shard.dim} dimensions)"
+    if shard.dim is None or (shard.embedding_model == args.model and shard.dim == target_dim):
+        return f"{session_key}: already {current}" if shard.dim else f"{session_key}: empty"
+    if args.dry_run:
+        return f"{session_key}: {current}, {rows} rows to re-index"
+
+    if args.truncate:
+        if shard.embedding_model != args.model or target_dim > shard.dim:
+            raise RuntimeError(f"cannot truncate {current} to {args.model} ({target_dim} dimensions)")
+        await asyncio.to_thread(_truncate, shard, target_dim, rows, generation)
+    else:
+        await _reembed(shard, args.model, args.dimension, target_dim, rows, generation)
+    return f"{session_key}: {current} -> {shard.embedding_model} ({shard.dim} dimensions), {rows} rows"
+
+async def run(args) -> int:
+    if args.truncate and not args.dimension:
+        print("--truncate needs --dimension (or EMBEDDING_DIMENSION)", file=sys.stderr)
+        return 2
+    target_dim = await target_dimension(args)
+    paths = sorted(glob.glob(os.path.join(vector_store.storage_dir, "sessions", "*", "meta.db")))
+    limiter = asyncio.Semaphore(args.parallel)
+    failures = 0
+
+    async def one(path: str):
+        nonlocal failures
+        async with limiter:
+            try:
+                print(await reindex_shard(path, args, target_dim))
+            except Exception as e:
+                failures += 1
+                print(f"{os.path.basename(os.path.dirname(path))}: FAILED, {e}")
+
+    await asyncio.gather(*(one(path) for path in paths))
+    print(f"{len(paths)} sessions, {failures} failed", file=sys.stderr)
+    return 1 if failures else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=settings.EMBEDDING_MODEL, help="target embedding model")
+    parser.add_argument("--dimension", type=int, default=settings.EMBEDDING_DIMENSION, help="target dimension")
+    parser.add_argument("--truncate", action="store_true", help="cut stored vectors instead of re-embedding")
+    parser.add_argument("--parallel", type=int, default=4, help="sessions processed at once")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be re-indexed")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
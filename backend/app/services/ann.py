@@ -0,0 +1,100 @@
+import numpy as np
+from typing import List, Optional
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, block: int = 4096) -> np.ndarray:
+    """Nearest centroid (by inner product) for each row, computed in blocks."""
+    out = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], block):
+        out[start:start + block] = np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+    return out
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """k-means on unit vectors with cosine similarity; returns unit-norm centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = _assign(vectors, centroids)
+        # Per-cluster sums as one matrix product; np.add.at is an order of magnitude slower
+        one_hot = np.zeros((vectors.shape[0], n_clusters), dtype=vectors.dtype)
+        one_hot[np.arange(vectors.shape[0]), labels] = 1
+        sums = one_hot.T @ vectors
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # Re-seed empty clusters from random points so every list stays useful
+        sums[empty] = vectors[rng.choice(vectors.shape[0], int(empty.sum()))]
+        norms[empty] = 1.0
+        centroids = sums / norms
+
+    return centroids.astype(np.float32)
+
+class IVFIndex:
+    """
+    Inverted-file index over a session's normalized rows: k-means centroids plus
+    one posting list of row numbers per centroid. A query scans only the rows in
+    the n_probe closest lists, so n_probe trades recall for latency.
+    """
+    def __init__(self, n_lists: int, seed: int = 0):
+        self.n_lists = n_lists
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[List[int]] = []
+        self.trained_size = 0
+
+    def train(self, matrix: np.ndarray, sample_per_list: int = 128):
+        """Fits centroids on (a sample of) matrix and indexes every row of it."""
+        self.fit(matrix[self.sample_rows(matrix.shape[0], sample_per_list)], matrix.shape[0])
+        self.reassign(matrix)
+
+    def sample_rows(self, rows: int, sample_per_list: int = 128) -> np.ndarray:
+        """Row numbers to fit on: all of them, or sample_per_list per list at random."""
+        if rows <= self.n_lists * sample_per_list:
+            return np.arange(rows)
+        rng = np.random.default_rng(self.seed)
+        return np.sort(rng.choice(rows, self.n_lists * sample_per_list, replace=False))
+
+    def fit(self, sample: np.ndarray, trained_size: int):
+        """Fits the centroids only; the index is empty until reassign() or add()."""
+        self.centroids = spherical_kmeans(sample, self.n_lists, seed=self.seed)
+        self.trained_size = trained_size
+        self.lists = [[] for _ in range(self.n_lists)]
+
+    @classmethod
+    def from_centroids(cls, centroids: np.ndarray, trained_size: int) -> "IVFIndex":
+        """An empty index over centroids fit earlier."""
+        index = cls(n_lists=centroids.shape[0])
+        index.centroids = centroids
+        index.trained_size = trained_size
+        index.lists = [[] for _ in range(index.n_lists)]
+        return index
+
+    def reassign(self, matrix: np.ndarray):
+        """Rebuilds the posting lists for matrix against the existing centroids."""
+        self.lists = [[] for _ in range(self.n_lists)]
+        self.add(matrix, 0)
+
+    def compact(self, keep: np.ndarray, rows: int):
+        """Drops every row not in keep (ascending) from the lists and renumbers the rest."""
+        new_rows = np.full(rows, -1, dtype=np.int64)
+        new_rows[keep] = np.arange(len(keep))
+        for i, members in enumerate(self.lists):
+            moved = new_rows[np.asarray(members, dtype=np.int64)]
+            self.lists[i] = moved[moved >= 0].tolist()
+
+    def add(self, vectors: np.ndarray, first_row: int):
+        for offset, label in enumerate(_assign(vectors, self.centroids)):
+            self.lists[label].append(first_row + offset)
+
+    def candidates(self, query: np.ndarray, n_probe: int) -> np.ndarray:
+        """Row numbers in the n_probe lists whose centroids are closest to query."""
+        n_probe = min(n_probe, self.n_lists)
+        closest = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        rows = [self.lists[c] for c in closest if self.lists[c]]
+        if not rows:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.asarray(r, dtype=np.int64) for r in rows])
+
+def recall_at_k(exact: List[np.ndarray], approximate: List[np.ndarray]) -> float:
+    """Mean fraction of the exact top-k that the approximate search also returned."""
+    hits = [len(np.intersect1d(e, a)) / len(e) for e, a in zip(exact, approximate) if len(e)]
+    return float(np.mean(hits)) if hits else 1.0
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from app.core.config import get_settings
+
+settings = get_settings()
+
+def normalize_text(text: str) -> str:
+    """Cache-key form of user text: case- and whitespace-insensitive."""
+    return re.sub(r'\s+', ' ', text).strip().casefold()
+
+_MISSING = object()
+
+class LRUCache:
+    """
+    Bounded in-process LRU cache with an optional SQLite tier that survives restarts.
+    Values must be JSON-serializable when the disk tier is enabled.
+    On the event loop use aget()/aset(): memory hits are answered in place, and the
+    disk tier is read and written in a worker thread.
+    """
+    def __init__(self, max_size: int, disk_path: Optional[str] = None, disk_max_size: Optional[int] = None):
+        self.max_size = max_size
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # memory tier and counters
+        self.disk_lock = threading.Lock()  # the SQLite connection; never held with `lock` waiting on it
+
+        self.disk = None
+        self.disk_max_size = disk_max_size or max_size * 10
+        if disk_path:
+            self.disk = sqlite3.connect(disk_path, check_same_thread=False)
+            # WAL with synchronous=NORMAL: a commit appends to the log without an fsync
+            self.disk.execute("PRAGMA journal_mode=WAL")
+            self.disk.execute("PRAGMA synchronous=NORMAL")
+            self.disk.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+            self.disk.commit()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        value = self._get_memory(key)
+        return self._get_disk([key])[0] if value is _MISSING else value
+
+    def set(self, key: Hashable, value: Any):
+        self._set_memory([(key, value)])
+        if self.disk is not None:
+            self._set_disk([(key, value)])
+
+    async def aget(self, key: Hashable) -> Optional[Any]:
+        return (await self.aget_many([key]))[key]
+
+    async def aset(self, key: Hashable, value: Any):
+        await self.aset_many([(key, value)])
+
+    async def aget_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Optional[Any]]:
+        """Looks up many keys; whatever memory misses is read from disk in one worker thread call."""
+        values = {key: self._get_memory(key) for key in keys}
+        missing = [key for key, value in values.items() if value is _MISSING]
+        if missing:
+            found = await asyncio.to_thread(self._get_disk, missing) if self.disk is not None \
+                else self._get_disk(missing)
+            values.update(zip(missing, found))
+        return values
+
+    async def aset_many(self, items: List[Tuple[Hashable, Any]]):
+        """Stores many entries; the disk tier is written in one worker thread call and one commit."""
+        self._set_memory(items)
+        if self.disk is not None:
+            await asyncio.to_thread(self._set_disk, items)
+
+    def _get_memory(self, key: Hashable) -> Any:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        return _MISSING
+
+    def _get_disk(self, keys: List[Hashable]) -> List[Optional[Any]]:
+        values = []
+        for key in keys:
+            row = None
+            if self.disk is not None:
+                with self.disk_lock:
+                    row = self.disk.execute("SELECT value FROM cache WHERE key = ?", (json.dumps(key),)).fetchone()
+            with self.lock:
+                if row is None:
+                    self.misses += 1
+                    values.append(None)
+                else:
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self.disk_hits += 1
+                    values.append(value)
+        return values
+
+    def _set_memory(self, items: List[Tuple[Hashable, Any]]):
+        with self.lock:
+            for key, value in items:
+                self._remember(key, value)
+
+    def _set_disk(self, items: List[Tuple[Hashable, Any]]):
+        with self.disk_lock:
+            self.disk.executemany(
+                "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                [(json.dumps(key), json.dumps(value)) for key, value in items]
+            )
+            # Oldest inserts go first once the disk tier is over budget
+            self.disk.execute(
+                "DELETE FROM cache WHERE rowid <= (SELECT MAX(rowid) FROM cache) - ?",
+                (self.disk_max_size,)
+            )
+            self.disk.commit()
+
+    def _remember(self, key: Hashable, value: Any):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
+
+class SessionTTLCache:
+    """
+    Bounded LRU cache whose entries expire after a TTL and are grouped by session,
+    so everything derived from one session's corpus can be dropped at once.
+    """
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[Tuple[str, Hashable], Tuple[float, Any]]" = OrderedDict()
+        self.session_keys: Dict[str, Set[Tuple[str, Hashable]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str, key: Hashable) -> Optional[Any]:
+        full_key = (session_id, key)
+        with self.lock:
+            entry = self.entries.get(full_key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(full_key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._drop(full_key)
+            self.misses += 1
+            return None
+
+    def set(self, session_id: str, key: Hashable, value: Any):
+        full_key = (session_id, key)
+        with self.lock:
+            self.entries[full_key] = (time.monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(full_key)
+            self.session_keys.setdefault(session_id, set()).add(full_key)
+            while len(self.entries) > self.max_size:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate_session(self, session_id: str):
+        with self.lock:
+            for full_key in self.session_keys.pop(session_id, set()):
+                self.entries.pop(full_key, None)
+
+    def _drop(self, full_key: Tuple[str, Hashable]):
+        self.entries.pop(full_key, None)
+        keys = self.session_keys.get(full_key[0])
+        if keys is not None:
+            keys.discard(full_key)
+            if not keys:
+                del self.session_keys[full_key[0]]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts the call
+    and everyone, the first caller included, awaits that one task. The task is
+    shielded, so a caller that goes away does not cancel it for the others.
+    Nothing is kept once the call finishes; remembering results is the caches' job.
+    """
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Task] = {}
+        self.waiters: Dict[Hashable, int] = {}
+        self.calls_started = 0
+        self.calls_coalesced = 0
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self.calls[key] = task
+            self.waiters[key] = 0
+            self.calls_started += 1
+            task.add_done_callback(lambda _: self._finish(key, task))
+        else:
+            self.calls_coalesced += 1
+
+        self.waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if key in self.waiters and self.calls.get(key) is task:
+                self.waiters[key] -= 1
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+            del self.waiters[key]
+        if not task.cancelled():
+            task.exception()  # retrieved by the waiters; don't warn if they all left
+
+    def stats(self) -> dict:
+        # Keys hold user questions, so only a digest of each is exposed
+        return {
+            "in_flight": len(self.calls),
+            "calls_started": self.calls_started,
+            "calls_coalesced": self.calls_coalesced,
+            "waiters": {
+                hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:12]: count
+                for key, count in self.waiters.items()
+            }
+        }
+
+# Query embeddings, keyed on (embedding model, dimension, normalized question)
+query_embedding_cache = LRUCache(
+    max_size=settings.QUERY_EMBEDDING_CACHE_SIZE,
+    disk_path=settings.QUERY_EMBEDDING_CACHE_FILE or None
+)
+
+# Generated answers, keyed on (chat model, normalized question, retrieved chunk ids)
+answer_cache = SessionTTLCache(
+    max_size=settings.ANSWER_CACHE_SIZE,
+    ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS
+)
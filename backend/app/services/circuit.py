@@ -0,0 +1,87 @@
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream the breaker has given up on for now."""
+    def __init__(self, name: str, retry_after: float):
+        self.retry_after = max(1, round(retry_after))
+        super().__init__(f"{name} is unavailable, retry in {self.retry_after}s")
+
+class CircuitBreaker:
+    """
+    closed:    calls go through; failure_threshold upstream failures in a row open it.
+    open:      calls fail at once with CircuitOpenError for reset_timeout seconds.
+    half_open: one trial call goes through; success closes the circuit, failure reopens it.
+    Only failures that say the upstream is in trouble (is_failure) count; any other
+    outcome, a bad request included, shows it is answering.
+    """
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float,
+                 is_failure: Callable[[Exception], bool]):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def check(self):
+        """Raises CircuitOpenError if a call made now would be rejected."""
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, remaining)
+            self.state = "half_open"
+        if self.state == "half_open" and self.trial_in_flight:
+            self.rejected += 1
+            raise CircuitOpenError(self.name, self.reset_timeout)
+
+    @contextmanager
+    def guard(self):
+        """Wraps one upstream call and records its outcome."""
+        self.check()
+        trial = self.state == "half_open"
+        if trial:
+            self.trial_in_flight = True
+        try:
+            yield
+        except Exception as e:
+            if self.is_failure(e):
+                self._record_failure()
+            else:
+                self._record_success()
+            raise
+        except BaseException:
+            # Cancelled: no verdict, let the next call be the trial
+            if trial:
+                self.trial_in_flight = False
+            raise
+        else:
+            self._record_success()
+
+    def _record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def _record_failure(self):
+        self.trial_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
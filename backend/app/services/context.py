@@ -0,0 +1,94 @@
+from typing import Dict, List, Tuple
+
+from app.utils import CHUNK_OVERLAP
+
+def estimate_tokens(text: str) -> int:
+    """Rough Gemini token count (about 4 characters per token), without a tokenizer round trip."""
+    return (len(text) + 3) // 4
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = text.lower().split()
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+def _similarity(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def join_overlapping(left: str, right: str, overlap: int = CHUNK_OVERLAP) -> str:
+    """
+    Concatenates consecutive chunks, writing the `overlap` characters they share
+    only once. Chunks that don't share exactly that (e.g. migrated from an older
+    chunker) are joined with a space, rather than guessing at repetitive text.
+    """
+    size = min(overlap, len(left), len(right))
+    if size and left.endswith(right[:size]):
+        return left + right[size:]
+    return left + " " + right
+
+def _drop_near_duplicates(runs: List[List[Tuple[int, Dict]]], threshold: float) -> List[List[Tuple[int, Dict]]]:
+    """
+    Drops passages all of whose chunks repeat text of a better passage, e.g. from the
+    same file uploaded twice. Passages are compared after merging, so a duplicate
+    never breaks up a run of consecutive chunks.
+    """
+    kept, seen = [], []
+    for run in runs:
+        shingles = [_shingles(res["doc"]["text"]) for _, res in run]
+        if all(any(_similarity(chunk, other) >= threshold for other in seen) for chunk in shingles):
+            continue
+        seen.extend(shingles)
+        kept.append(run)
+    return kept
+
+def _passages(results: List[Dict]) -> List[List[Tuple[int, Dict]]]:
+    """
+    Groups results into runs of consecutive chunks of the same document (chunk ids
+    are assigned in order within a document). Runs are ordered by their best result.
+    """
+    by_document: Dict[str, List[Tuple[int, int, Dict]]] = {}
+    for rank, res in enumerate(results):
+        doc = res["doc"]
+        by_document.setdefault(doc.get("doc_id") or doc["source"], []).append((doc["id"], rank, res))
+
+    runs = []
+    for members in by_document.values():
+        members.sort(key=lambda member: member[0])
+        run = [members[0]]
+        for member in members[1:]:
+            if member[0] == run[-1][0] + 1:
+                run.append(member)
+            else:
+                runs.append(run)
+                run = [member]
+        runs.append(run)
+    runs.sort(key=lambda run: min(rank for _, rank, _ in run))
+    return [[(rank, res) for _, rank, res in run] for run in runs]
+
+def pack_context(results: List[Dict], token_budget: int, dedup_threshold: float) -> Dict:
+    """
+    Turns retrieval results (best first) into the context passed to generate_answer:
+    near-duplicates are dropped, consecutive chunks of a document are merged into
+    one passage, and passages are packed best first while they fit token_budget.
+    The best passage is always included. Returns the passage texts, the results
+    they contain (for citations, in score order) and estimated tokens before/after.
+    """
+    tokens_before = sum(estimate_tokens(res["doc"]["text"]) for res in results)
+
+    chunks, included, tokens_after = [], [], 0
+    for run in _drop_near_duplicates(_passages(results), dedup_threshold):
+        text = run[0][1]["doc"]["text"]
+        for _, res in run[1:]:
+            text = join_overlapping(text, res["doc"]["text"])
+        tokens = estimate_tokens(text)
+        if chunks and tokens_after + tokens > token_budget:
+            continue  # a smaller passage further down may still fit
+        chunks.append(text)
+        included.extend(run)
+        tokens_after += tokens
+
+    included.sort(key=lambda member: member[0])
+    return {
+        "chunks": chunks,
+        "results": [res for _, res in included],
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after
+    }
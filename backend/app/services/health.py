@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from app.core.config import get_settings
+from app.services.llm import check_connection, gemini_breaker
+from app.services.storage import vector_store
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class HealthProber:
+    """
+    Probes Gemini and the store in the background, so /api/health answers from the
+    last result however often the load balancer asks. Gemini counts as down while
+    the circuit breaker is open, even if the last probe got through.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.gemini = "unknown"
+        self.storage = "unknown"
+        self.checked_at: Optional[float] = None
+
+    async def probe(self):
+        self.gemini = "ok" if await check_connection() else "error"
+        self.storage = "ok" if await asyncio.to_thread(self._check_storage) else "error"
+        self.checked_at = time.time()
+
+    @staticmethod
+    def _check_storage() -> bool:
+        try:
+            with vector_store.meta.connection() as db:
+                db.execute("SELECT 1").fetchone()
+            return True
+        except Exception:
+            return False
+
+    async def run(self):
+        """Background task: probes immediately, then every interval."""
+        while True:
+            try:
+                await self.probe()
+            except Exception:
+                logger.exception("Health probe failed")
+            await asyncio.sleep(self.interval)
+
+    def status(self) -> dict:
+        gemini = self.gemini
+        if gemini == "ok" and gemini_breaker.state == "open":
+            gemini = "error"
+        return {
+            "backend": "ok",
+            "storage": self.storage,
+            "gemini": gemini,
+            "gemini_circuit": gemini_breaker.state,
+            "checked_at": self.checked_at
+        }
+
+# Global instance, started with the app
+health_prober = HealthProber(interval=settings.HEALTH_CHECK_INTERVAL_SECONDS)
@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from app.core.config import get_settings
+from app.core.metrics import timed
+from app.models import Document, IngestionJob
+from app.services.llm import get_embeddings
+from app.services.storage import vector_store
+from app.utils import iter_text_blocks, iter_clean_text, iter_chunks
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class IngestionTask:
+    """One uploaded file waiting for (or going through) chunking and embedding."""
+    def __init__(self, session_id: str, filename: str, upload_dir: str):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.filename = filename
+        # Spooled copy of the upload, removed when the job ends
+        os.makedirs(upload_dir, exist_ok=True)
+        self.path = os.path.join(upload_dir, self.id + ".txt")
+        self.status = "queued"
+        self.chunks_processed = 0
+        self.chunks_total: Optional[int] = None
+        self.chunks_reused = 0
+        self.document: Optional[Document] = None
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        self.publishing = asyncio.Lock()  # status updates reach store.db in order
+
+    def to_model(self) -> IngestionJob:
+        return IngestionJob(
+            id=self.id,
+            filename=self.filename,
+            status=self.status,
+            chunks_processed=self.chunks_processed,
+            chunks_total=self.chunks_total,
+            chunks_reused=self.chunks_reused,
+            document=self.document,
+            error=self.error
+        )
+
+    def _chunks(self):
+        with open(self.path, 'rb') as f:
+            yield from iter_chunks(iter_clean_text(iter_text_blocks(f)))
+
+    def content_hash(self) -> str:
+        digest = hashlib.sha256()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def count_chunks(self) -> int:
+        # Cheap compared to embedding, and validates the whole file before any API calls
+        return sum(1 for _ in self._chunks())
+
+INTERRUPTED_ERROR = "Processing was interrupted by a server restart; please upload the file again"
+
+class IngestionQueue:
+    """
+    Bounded queue of uploads processed by a fixed pool of worker tasks.
+    submit() raises asyncio.QueueFull when the backlog is at capacity.
+
+    The queue lives in this process only, so a heartbeat keeps its unfinished jobs
+    fresh in store.db, and jobs nobody has kept fresh for a few heartbeats (the
+    process restarted or crashed) are marked failed.
+    """
+    def __init__(self, max_queued: int, workers: int):
+        self.queue: "asyncio.Queue[IngestionTask]" = asyncio.Queue(maxsize=max_queued)
+        self.worker_count = workers
+        self.workers: List[asyncio.Task] = []
+        self.tasks: Dict[str, IngestionTask] = {}
+
+    def start(self):
+        for _ in range(self.worker_count):
+            self.workers.append(asyncio.create_task(self._work()))
+        self.workers.append(asyncio.create_task(self._heartbeat()))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def submit(self, task: IngestionTask):
+        self._prune()
+        self.queue.put_nowait(task)
+        self.tasks[task.id] = task
+        await self._publish(task)
+
+    async def get(self, job_id: str, session_id: str) -> Optional[IngestionJob]:
+        task = self.tasks.get(job_id)
+        if task is not None:
+            return task.to_model() if task.session_id == session_id else None
+        # Submitted to another worker process
+        job = await asyncio.to_thread(vector_store.get_job, job_id, session_id)
+        return IngestionJob(**job) if job is not None else None
+
+    async def _publish(self, task: IngestionTask):
+        """Shares the job's status with other workers; a failure only leaves their copy stale."""
+        async with task.publishing:
+            try:
+                await asyncio.to_thread(vector_store.publish_job, task.id, task.session_id, task.to_model().model_dump())
+            except Exception:
+                logger.exception(f"Publishing the status of ingestion job {task.id} failed")
+
+    async def _heartbeat(self):
+        interval = settings.INGEST_JOB_HEARTBEAT_SECONDS
+        while True:
+            try:
+                unfinished = [task.id for task in self.tasks.values() if task.finished_at is None]
+                await asyncio.to_thread(vector_store.touch_jobs, unfinished)
+                failed = await asyncio.to_thread(vector_store.fail_stale_jobs, time.time() - 3 * interval, INTERRUPTED_ERROR)
+                if failed:
+                    logger.warning(f"Marked {failed} interrupted ingestion jobs as failed")
+            except Exception:
+                logger.exception("Ingestion job heartbeat failed")
+            await asyncio.sleep(interval)
+
+    def _prune(self):
+        cutoff = time.monotonic() - settings.INGEST_JOB_RETENTION_SECONDS
+        for job_id in [j for j, t in self.tasks.items() if t.finished_at and t.finished_at < cutoff]:
+            del self.tasks[job_id]
+
+    async def _work(self):
+        while True:
+            task = await self.queue.get()
+            try:
+                await self._process(task)
+            except ValueError as e:
+                # Validation problems with the file itself (empty, not UTF-8, ...)
+                task.status = "failed"
+                task.error = str(e)
+            except Exception:
+                logger.exception(f"Ingestion job {task.id} failed")
+                task.status = "failed"
+                task.error = "Failed to process the file"
+            finally:
+                task.finished_at = time.monotonic()
+                try:
+                    if os.path.exists(task.path):
+                        os.remove(task.path)
+                    await self._publish(task)
+                finally:
+                    self.queue.task_done()
+
+    async def _process(self, task: IngestionTask):
+        task.status = "processing"
+        with timed("ingest", "hash"):
+            content_hash = await asyncio.to_thread(task.content_hash)
+            existing = await asyncio.to_thread(vector_store.find_document, content_hash, task.session_id)
+        if existing is not None:
+            # The session already has this exact file
+            task.document = Document(**existing)
+            task.chunks_total = task.chunks_processed = task.chunks_reused = existing["chunk_count"]
+            task.status = "completed"
+            return
+
+        with timed("ingest", "chunk"):
+            task.chunks_total = await asyncio.to_thread(task.count_chunks)
+        if task.chunks_total == 0:
+            raise ValueError("File is empty")
+        await self._publish(task)
+
+        # A new version of a file in the session replaces it; its unchanged chunks keep their vectors
+        previous, reusable = await asyncio.to_thread(vector_store.previous_version, task.filename, task.session_id)
+        staging = vector_store.stage_upload(
+            source=task.filename, session_id=task.session_id, content_hash=content_hash,
+            replaces=previous["id"] if previous is not None else None
+        )
+        window = settings.EMBEDDING_BATCH_SIZE * settings.EMBEDDING_CONCURRENCY
+        chunks = task._chunks()
+        # Whether the chunks come out exactly as the previous version's, e.g. only line endings changed
+        unchanged, previous_ids = previous is not None, iter(reusable.values())
+
+        def next_batch() -> tuple:
+            """Reads and chunks the file up to the next batch to stage; runs in a thread."""
+            nonlocal unchanged
+            batch, reused, new = [], [], 0
+            for chunk in chunks:
+                batch.append(chunk)
+                reused.append(reusable.get(chunk))
+                new += reused[-1] is None
+                unchanged = unchanged and reused[-1] is not None and reused[-1] == next(previous_ids, None)
+                # Full embedding windows; runs of reused chunks are spooled every few windows
+                if new == window or len(batch) == 4 * window:
+                    break
+            return batch, reused
+
+        try:
+            while True:
+                batch, reused = await asyncio.to_thread(next_batch)
+                if not batch:
+                    break
+                await self._stage(task, staging, batch, reused)
+        except Exception:
+            staging.discard()
+            raise
+        finally:
+            chunks.close()
+
+        if unchanged and next(previous_ids, None) is None:
+            staging.discard()
+            task.document = Document(**previous)
+            task.status = "completed"
+            return
+
+        # Searchable only from here on, all chunks at once
+        with timed("ingest", "commit"):
+            task.document = Document(**await asyncio.to_thread(vector_store.commit_upload, staging))
+        task.status = "completed"
+
+    async def _stage(self, task: IngestionTask, staging, batch: List[str], reused: List[Optional[int]]):
+        """Embeds the chunks of a batch that have no vector to reuse, and spools the batch."""
+        texts = [text for text, chunk_id in zip(batch, reused) if chunk_id is None]
+        with timed("ingest", "embed"):
+            embeddings = await get_embeddings(texts) if texts else []
+            # Converting a window of Python floats and writing the spool takes tens of milliseconds
+            await asyncio.to_thread(staging.add, batch, embeddings, reused)
+        task.chunks_processed += len(batch)
+        task.chunks_reused += len(batch) - len(texts)
+        await self._publish(task)
+
+# Global instance, started with the app
+ingestion_queue = IngestionQueue(
+    max_queued=settings.INGEST_QUEUE_SIZE,
+    workers=settings.INGEST_WORKERS
+)
@@ -0,0 +1,138 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+# Identifiers such as "ERR-404", "SKU_1234" or "v2.1.3" stay whole, and are also
+# indexed by their parts so "404" alone still matches. Words are Unicode letters
+# and digits; Chinese and Japanese are written without spaces, so each ideograph
+# or kana is a token of its own.
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_WORD = rf"[^\W_{_CJK}]+"
+_TOKEN = re.compile(rf"[{_CJK}]|{_WORD}(?:[-_.:/]{_WORD})*")
+_PART = re.compile(_WORD)
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    # NFKC, so composed and decomposed accents, and full-width letters, match
+    for match in _TOKEN.finditer(unicodedata.normalize("NFKC", text).lower()):
+        token = match.group()
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(_PART.findall(token))
+    return tokens
+
+class LexicalIndex:
+    """
+    Inverted index over one session's chunks, scored with BM25 (Okapi).
+    Postings map term -> {position: term frequency}; adds and removes touch only
+    the terms of the chunks involved. Searches score each term's postings as NumPy
+    arrays, built on first use and dropped when the term's postings change, so
+    words that occur in nearly every chunk cost little.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.lengths: Dict[int, int] = {}  # position -> chunk length in tokens
+        self.total_length = 0
+        self.length_array = np.zeros(0, dtype=np.float64)  # lengths by position, for scoring
+        self.arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}  # term -> (positions, term frequencies)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, position: int, text: str):
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[position] = tf
+            self.arrays.pop(term, None)
+        length = sum(counts.values())
+        self.lengths[position] = length
+        self.total_length += length
+        if position >= len(self.length_array):
+            grown = np.zeros(max(16, 2 * len(self.length_array), position + 1), dtype=np.float64)
+            grown[:len(self.length_array)] = self.length_array
+            self.length_array = grown
+        self.length_array[position] = length
+
+    def remove(self, position: int, text: str):
+        length = self.lengths.pop(position, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in set(tokenize(text)):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(position, None)
+            self.arrays.pop(term, None)
+            if not postings:
+                del self.postings[term]
+
+    def remap(self, new_positions):
+        """Re-keys postings after the store was compacted (old position -> new)."""
+        self.lengths = {int(new_positions[pos]): length for pos, length in self.lengths.items()}
+        self.postings = {
+            term: {int(new_positions[pos]): tf for pos, tf in postings.items()}
+            for term, postings in self.postings.items()
+        }
+        self.length_array = np.zeros(max(self.lengths, default=-1) + 1, dtype=np.float64)
+        for position, length in self.lengths.items():
+            self.length_array[position] = length
+        self.arrays = {}
+
+    def _arrays(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        arrays = self.arrays.get(term)
+        if arrays is None:
+            postings = self.postings[term]
+            arrays = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float64, count=len(postings))
+            )
+            self.arrays[term] = arrays
+        return arrays
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Returns (position, BM25 score) pairs, best first; ties go to the earlier chunk."""
+        n = len(self.lengths)
+        if n == 0 or k <= 0:
+            return []
+        avg_length = self.total_length / n or 1.0
+
+        scores = np.zeros(len(self.length_array), dtype=np.float64)
+        matched = False
+        for term in set(tokenize(query)):
+            if not self.postings.get(term):
+                continue
+            positions, tf = self._arrays(term)
+            df = len(positions)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.length_array[positions] / avg_length)
+            scores[positions] += idf * tf * (self.k1 + 1) / (tf + norm)
+            matched = True
+        if not matched:
+            return []
+
+        # Every posting scores above zero
+        candidates = np.flatnonzero(scores)
+        if k < len(candidates):
+            # All ties with the k-th best, so the earliest of them win as in a full sort
+            kth = np.partition(scores[candidates], len(candidates) - k)[len(candidates) - k]
+            candidates = candidates[scores[candidates] >= kth]
+        top = np.lexsort((candidates, -scores[candidates]))[:k]
+        return [(int(candidates[i]), float(scores[candidates[i]])) for i in top]
+
+def reciprocal_rank_fusion(rankings: Iterable[List[Tuple[int, float]]], k: int, c: int = 60) -> List[Tuple[int, float]]:
+    """
+    Fuses ranked (position, score) lists by sum(1 / (c + rank)). Only ranks are used,
+    so cosine and BM25 scores never need to be put on the same scale.
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (position, _) in enumerate(ranking, start=1):
+            fused[position] = fused.get(position, 0.0) + 1.0 / (c + rank)
+    return sorted(fused.items(), key=lambda item: (-item[1], item[0]))[:k]
@@ -1,7 +1,13 @@
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 from app.core.config import get_settings
-from typing import List
+from app.core.metrics import GEMINI_ERRORS, GEMINI_RETRIES
+from app.services.cache import SingleFlight, query_embedding_cache, normalize_text
+from app.services.circuit import CircuitBreaker
+from typing import AsyncIterator, List, Optional
+import asyncio
+import httpx
+import random
 import time
 import logging
 
@@ -9,29 +15,132 @@ settings = get_settings()
 client = genai.Client(api_key=settings.GOOGLE_API_KEY)
 logger = logging.getLogger(__name__)
 
-def get_embedding(text: str) -> List[float]:
-    """Generates embedding for the given text using the configured model."""
-    text = text.replace("\n", " ")
-    
+# Caps concurrent Gemini requests across the whole process
+_gemini_limiter = asyncio.Semaphore(settings.GEMINI_MAX_CONCURRENCY)
+
+# Identical requests already in flight share one upstream call
+_embedding_flights = SingleFlight()
+_answer_flights = SingleFlight()
+
+def _is_upstream_failure(e: Exception) -> bool:
+    """Rate limits, server errors and network failures; not our own bad requests."""
+    if isinstance(e, errors.APIError):
+        return e.code == 429 or e.code >= 500
+    return "429" in str(e) or isinstance(e, (httpx.TransportError, ConnectionError, asyncio.TimeoutError))
+
+# Stops sending requests while Gemini keeps failing, so callers fail fast instead of sleeping through retries
+gemini_breaker = CircuitBreaker(
+    "Gemini",
+    failure_threshold=settings.GEMINI_BREAKER_FAILURES,
+    reset_timeout=settings.GEMINI_BREAKER_RESET_SECONDS,
+    is_failure=_is_upstream_failure
+)
+
+# Shared 429 backoff: once any call is rate limited, every call waits it out
+_backoff_until = 0.0
+
+def _backoff_delay(attempt: int, base: float) -> float:
+    """Exponential backoff with jitter so retries from many requests don't line up."""
+    ceiling = base * (2 ** attempt)
+    return random.uniform(ceiling / 2, ceiling)
+
+async def _wait_for_backoff():
+    delay = _backoff_until - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+def _back_off(wait_time: float):
+    global _backoff_until
+    _backoff_until = max(_backoff_until, time.monotonic() + wait_time)
+
+async def _call_with_retries(call, base_wait: float, label: str):
     max_retries = 3
     for attempt in range(max_retries):
+        gemini_breaker.check()  # before sleeping out a backoff, not after
+        await _wait_for_backoff()
         try:
-            result = client.models.embed_content(
-                model=settings.EMBEDDING_MODEL,
-                contents=text
-            )
-            return result.embeddings[0].values
+            async with _gemini_limiter:
+                with gemini_breaker.guard():
+                    return await call()
         except Exception as e:
             if "429" in str(e) and attempt < max_retries - 1:
-                wait_time = (attempt + 1) * 2
-                logger.warning(f"Embedding rate limit hit, retrying in {wait_time}s...")
-                time.sleep(wait_time)
+                wait_time = _backoff_delay(attempt, base_wait)
+                logger.warning(f"{label} rate limit hit, retrying in {wait_time:.1f}s...")
+                GEMINI_RETRIES.inc(call=label)
+                _back_off(wait_time)
                 continue
+            GEMINI_ERRORS.inc(call=label)
             raise e
 
-def generate_answer(query: str, context_chunks: List[str]) -> str:
-    """Generates an answer based on the query and retrieved context."""
-    
+async def _embed_batch(texts: List[str], model: str, dimension: Optional[int]) -> List[List[float]]:
+    contents = [text.replace("\n", " ") for text in texts]
+
+    async def call():
+        result = await client.aio.models.embed_content(
+            model=model,
+            contents=contents,
+            config=types.EmbedContentConfig(output_dimensionality=dimension) if dimension else None
+        )
+        return [embedding.values for embedding in result.embeddings]
+
+    return await _call_with_retries(call, base_wait=2, label="Embedding")
+
+async def get_embeddings(texts: List[str], model: Optional[str] = None,
+                         dimension: Optional[int] = None) -> List[List[float]]:
+    """
+    Embeds many texts with batched embed_content requests, several in flight at once.
+    Results are returned in the same order as the input. model and dimension default
+    to EMBEDDING_MODEL and EMBEDDING_DIMENSION.
+    """
+    model = model or settings.EMBEDDING_MODEL
+    dimension = dimension or settings.EMBEDDING_DIMENSION
+    batch_size = settings.EMBEDDING_BATCH_SIZE
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    batch_limiter = asyncio.Semaphore(settings.EMBEDDING_CONCURRENCY)
+
+    async def run(batch):
+        async with batch_limiter:
+            return await _embed_batch(batch, model, dimension)
+
+    results = await asyncio.gather(*(run(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
+async def get_embedding(text: str) -> List[float]:
+    """Generates embedding for the given text using the configured model."""
+    return (await _embed_batch([text], settings.EMBEDDING_MODEL, settings.EMBEDDING_DIMENSION))[0]
+
+async def get_query_embedding(question: str) -> List[float]:
+    """Embeds a user question, reusing cached vectors for repeated questions."""
+    key = (settings.EMBEDDING_MODEL, settings.EMBEDDING_DIMENSION, normalize_text(question))
+    vector = await query_embedding_cache.aget(key)
+    if vector is not None:
+        return vector
+
+    async def fetch():
+        vector = await get_embedding(question)
+        await query_embedding_cache.aset(key, list(vector))
+        return vector
+
+    return await _embedding_flights.do(key, fetch)
+
+async def get_query_embeddings(questions: List[str]) -> List[List[float]]:
+    """
+    get_query_embedding for many questions: cached ones are reused, and the rest,
+    each distinct question once, go out in batched embed_content calls.
+    """
+    keys = [(settings.EMBEDDING_MODEL, settings.EMBEDDING_DIMENSION, normalize_text(question)) for question in questions]
+    vectors = await query_embedding_cache.aget_many(set(keys))
+    missing = {}
+    for key, question in zip(keys, questions):
+        if vectors[key] is None:
+            missing.setdefault(key, question)
+    if missing:
+        embedded = list(zip(missing, await get_embeddings(list(missing.values()))))
+        await query_embedding_cache.aset_many([(key, list(vector)) for key, vector in embedded])
+        vectors.update(embedded)
+    return [vectors[key] for key in keys]
+
+def _build_prompt(query: str, context_chunks: List[str]):
     context_text = "\n\n---\n\n".join(context_chunks)
     
     system_instruction = """You are a helpful assistant for a Private Knowledge Q&A system.
@@ -45,32 +154,64 @@ Do not hallucinate or use outside knowledge.
 
 Question: {query}
 """
+    return system_instruction, user_message
 
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = client.models.generate_content(
-                model=settings.CHAT_MODEL,
-                contents=user_message,
-                config=types.GenerateContentConfig(
-                    system_instruction=system_instruction,
-                    temperature=0.0
-                )
+async def generate_answer(query: str, context_chunks: List[str]) -> str:
+    """
+    Generates an answer based on the query and retrieved context. Concurrent calls
+    for the same (normalized) question and chunks share one Gemini request.
+    """
+    key = (settings.CHAT_MODEL, normalize_text(query), tuple(context_chunks))
+    return await _answer_flights.do(key, lambda: _generate_answer(query, context_chunks))
+
+async def _generate_answer(query: str, context_chunks: List[str]) -> str:
+    system_instruction, user_message = _build_prompt(query, context_chunks)
+
+    async def call():
+        response = await client.aio.models.generate_content(
+            model=settings.CHAT_MODEL,
+            contents=user_message,
+            config=types.GenerateContentConfig(
+                system_instruction=system_instruction,
+                temperature=0.0
             )
-            return response.text
-        except Exception as e:
-            if "429" in str(e) and attempt < max_retries - 1:
-                wait_time = (attempt + 1) * 5
-                logger.warning(f"Chat rate limit hit, retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                continue
-            raise e
+        )
+        return response.text
+
+    return await _call_with_retries(call, base_wait=5, label="Chat")
+
+async def stream_answer(query: str, context_chunks: List[str]) -> AsyncIterator[str]:
+    """Same prompt as generate_answer, but yields answer text as Gemini produces it."""
+    system_instruction, user_message = _build_prompt(query, context_chunks)
+
+    async def call():
+        return await client.aio.models.generate_content_stream(
+            model=settings.CHAT_MODEL,
+            contents=user_message,
+            config=types.GenerateContentConfig(
+                system_instruction=system_instruction,
+                temperature=0.0
+            )
+        )
+
+    # Retries only cover opening the stream; nothing has been sent to the client yet
+    stream = await _call_with_retries(call, base_wait=5, label="Chat")
+    async for chunk in stream:
+        if chunk.text:
+            yield chunk.text
+
+def inflight_stats() -> dict:
+    """Coalescing counters and current waiters per in-flight key."""
+    return {
+        "query_embeddings": _embedding_flights.stats(),
+        "answers": _answer_flights.stats()
+    }
 
-def check_connection() -> bool:
+async def check_connection() -> bool:
+    """One model lookup; bypasses the circuit breaker so it can see a recovery first."""
     try:
-        # Simple test to check if we can list models
-        models = client.models.list()
-        # Just check if we get anything back
+        async with _gemini_limiter:
+            await client.aio.models.get(model=settings.EMBEDDING_MODEL)
         return True
     except Exception:
         return False
@@ -0,0 +1,52 @@
+import numpy as np
+from typing import Optional, Tuple
+
+ENCODINGS = ("float32", "float16", "int8")
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Unit-length float32 rows; zero vectors stay zero."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+def encode(unit_vectors: np.ndarray, encoding: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Compact codes for normalized rows. int8 stores one float32 scale per row
+    (max |component| / 127); the other encodings need no scales.
+    """
+    if encoding == "float32":
+        return unit_vectors.astype(np.float32), None
+    if encoding == "float16":
+        return unit_vectors.astype(np.float16), None
+    if encoding == "int8":
+        scales = np.abs(unit_vectors).max(axis=1, initial=0.0) / 127.0
+        safe = np.where(scales > 0, scales, 1.0)
+        codes = np.rint(unit_vectors / safe[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unknown vector encoding: {encoding}")
+
+def decode(codes: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+    decoded = codes.astype(np.float32)
+    if scales is not None:
+        decoded *= scales[:, None]
+    return decoded
+
+def approximate_scores(codes: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray,
+                       block: int = 4096) -> np.ndarray:
+    """
+    codes . query for every row, decoding in blocks so no full float32 copy is made.
+    A (dim,) query gives (rows,) scores; a (dim, n) matrix of queries gives (rows, n).
+    """
+    if codes.dtype == np.float32:
+        return codes @ query
+    scores = np.empty((codes.shape[0],) + query.shape[1:], dtype=np.float32)
+    for start in range(0, codes.shape[0], block):
+        scores[start:start + block] = codes[start:start + block].astype(np.float32) @ query
+    if scales is not None:
+        scores *= scales.reshape((-1,) + (1,) * (query.ndim - 1))
+    return scores
+
+def bytes_per_vector(dim: int, encoding: str) -> int:
+    if encoding == "int8":
+        return dim + 4
+    return dim * np.dtype(encoding).itemsize
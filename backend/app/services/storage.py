@@ -1,90 +1,1557 @@
+import asyncio
+import bisect
+import glob
+import hashlib
 import json
+import logging
 import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional
 from app.core.config import get_settings
+from app.core.metrics import SESSION_EVICTIONS, SESSION_PAGE_INS, STORE_SECONDS
+from app.services.ann import IVFIndex
+from app.services.lexical import LexicalIndex, reciprocal_rank_fusion
+from app.services.locks import RWLock
+from app.services.quantization import (
+    approximate_scores, decode, encode, normalize, bytes_per_vector
+)
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+STORAGE_FORMAT = 3
+
+class EmbeddingSpaceError(RuntimeError):
+    """A session's vectors come from another embedding model or dimension than the query."""
+
+SHARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS chunks (
+    position INTEGER PRIMARY KEY,  -- row in the vector segments
+    id INTEGER NOT NULL,           -- stable chunk id, survives compaction
+    text TEXT NOT NULL,
+    source TEXT,
+    doc_id TEXT
+);
+CREATE INDEX IF NOT EXISTS chunks_by_document ON chunks (doc_id);
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    upload_date TEXT,
+    chunk_count INTEGER,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    content_hash TEXT  -- SHA-256 of the uploaded file
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,  -- add | delete | compact
+    doc_id TEXT
+)
+"""
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, session_id TEXT, data TEXT, updated REAL);
+CREATE INDEX IF NOT EXISTS jobs_by_update ON jobs (updated)
+"""
+
+_CACHE_KIB = 2000  # SQLite page cache per connection (its default)
+
+def _connect(path: str, schema: str) -> sqlite3.Connection:
+    db = sqlite3.connect(
+        path,
+        timeout=settings.STORAGE_LOCK_TIMEOUT_SECONDS,
+        isolation_level=None,  # transactions are explicit
+        check_same_thread=False  # pooled; one thread at a time leases it
+    )
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(f"PRAGMA cache_size=-{_CACHE_KIB}")
+    for statement in schema.split(";"):
+        db.execute(statement)
+    return db
+
+class _Database:
+    """
+    A pool of at most STORAGE_DB_CONNECTIONS SQLite connections to one file. A thread
+    leases one for the length of connection(), nested calls reuse it, so a transaction
+    never shares its connection; `db` is the leased one. Connections inherited through
+    fork() are unusable and are dropped.
+    """
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self.schema = schema
+        self.closed = False
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.slots = threading.Semaphore(settings.STORAGE_DB_CONNECTIONS)
+        self.pool_lock = threading.Lock()
+        self.idle: List[sqlite3.Connection] = []
+        self.open = 0
+
+    @contextmanager
+    def connection(self):
+        if self.pid != os.getpid():
+            self._reset()
+        leased = getattr(self.local, "db", None)
+        if leased is not None:
+            yield leased
+            return
+        with self.slots:
+            with self.pool_lock:
+                db = self.idle.pop() if self.idle else None
+            if db is None:
+                db = _connect(self.path, self.schema)
+                with self.pool_lock:
+                    self.open += 1
+            self.local.db = db
+            try:
+                yield db
+            finally:
+                self.local.db = None
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                with self.pool_lock:
+                    if self.closed:
+                        db.close()
+                        self.open -= 1
+                    else:
+                        self.idle.append(db)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None or self.pid != os.getpid():
+            raise RuntimeError(f"No connection to {self.path} leased by this thread")
+        return db
+
+    def close(self):
+        """Closes the idle connections now and leased ones when they come back; later leases still work."""
+        with self.pool_lock:
+            self.closed = True
+            for db in self.idle:
+                db.close()
+            self.open -= len(self.idle)
+            self.idle = []
+
+    def cache_bytes(self) -> int:
+        """Upper bound on the page cache held by the open connections."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return 0
+        return self.open * min(size, _CACHE_KIB * 1024)
+
+    def get_state(self, key: str, default=None):
+        with self.connection() as db:
+            row = db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, **values):
+        with self.connection() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in values.items()]
+            )
+
+class SessionIndex:
+    """
+    Pre-normalized vectors for one session in one contiguous block of codes, in the
+    store's vector encoding (float32, float16 or int8 with per-row scales).
+    Rows are kept in insertion order so ties resolve like the old linear scan.
+    """
+    def __init__(self, encoding: str, exact_vectors: Callable[[List[int]], np.ndarray]):
+        self.encoding = encoding
+        self.exact_vectors = exact_vectors  # positions -> raw float32 rows, for rescoring
+        self.codes = None           # capacity x dim, only [:size] is in use
+        self.scales = None          # per-row scales (int8 only)
+        self.size = 0
+        self.positions: List[int] = []  # row -> index into shard.documents, ascending
+        self.alive = None           # row -> False once its chunk is tombstoned
+        self.dead = 0
+        self.compactions = 0
+        self.ivf: Optional[IVFIndex] = None  # only for sessions of ANN_MIN_SIZE rows or more
+
+    def extend(self, codes: np.ndarray, scales: Optional[np.ndarray], positions: List[int]):
+        count = codes.shape[0]
+        if self.codes is None:
+            self.codes = np.zeros((max(16, count), codes.shape[1]), dtype=codes.dtype)
+            self.alive = np.zeros(self.codes.shape[0], dtype=bool)
+            if scales is not None:
+                self.scales = np.zeros(self.codes.shape[0], dtype=np.float32)
+        elif self.size + count > self.codes.shape[0]:
+            # Amortized O(1) growth
+            capacity = max(self.codes.shape[0] * 2, self.size + count)
+            grown = np.zeros((capacity, self.codes.shape[1]), dtype=self.codes.dtype)
+            grown[:self.size] = self.codes[:self.size]
+            self.codes = grown
+            grown_alive = np.zeros(capacity, dtype=bool)
+            grown_alive[:self.size] = self.alive[:self.size]
+            self.alive = grown_alive
+            if self.scales is not None:
+                grown_scales = np.zeros(capacity, dtype=np.float32)
+                grown_scales[:self.size] = self.scales[:self.size]
+                self.scales = grown_scales
+
+        self.codes[self.size:self.size + count] = codes
+        self.alive[self.size:self.size + count] = True
+        if self.scales is not None:
+            self.scales[self.size:self.size + count] = scales
+        self.positions.extend(positions)
+        self.size += count
+        self._update_ann(self.size - count, count)
+
+    def _decoded(self, start: int, stop: int) -> np.ndarray:
+        scales = self.scales[start:stop] if self.scales is not None else None
+        return decode(self.codes[start:stop], scales)
+
+    def _update_ann(self, first_row: int, count: int):
+        if not settings.ANN_ENABLED or self.size < settings.ANN_MIN_SIZE:
+            self.ivf = None
+            return
+        # Centroids are fit by SessionShard.train_ann(), outside the lock; until then searches are exact
+        if self.ivf is not None:
+            self.ivf.add(self._decoded(first_row, first_row + count), first_row)
+
+    @property
+    def needs_training(self) -> bool:
+        """Large enough for an IVF index but without one, or doubled since its centroids were fit."""
+        return settings.ANN_ENABLED and self.size >= settings.ANN_MIN_SIZE and (
+            self.ivf is None or self.size > 2 * self.ivf.trained_size
+        )
+
+    def kill(self, positions: List[int]):
+        """Hides the rows of tombstoned chunks from search; space is reclaimed by compact()."""
+        for position in positions:
+            row = bisect.bisect_left(self.positions, position)
+            if row < self.size and self.positions[row] == position and self.alive[row]:
+                self.alive[row] = False
+                self.dead += 1
+
+    @property
+    def live_count(self) -> int:
+        return self.size - self.dead
+
+    def compact(self):
+        """Physically drops dead rows."""
+        if not self.dead:
+            return
+        keep = np.flatnonzero(self.alive[:self.size])
+        if self.ivf is not None and len(keep) >= settings.ANN_MIN_SIZE:
+            self.ivf.compact(keep, self.size)
+        else:
+            self.ivf = None
+        self.codes = self.codes[keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+        if self.scales is not None:
+            self.scales = self.scales[keep]
+        self.positions = [self.positions[i] for i in keep]
+        self.size = len(keep)
+        self.dead = 0
+        self.compactions += 1
+
+    def remap(self, new_positions: np.ndarray):
+        """Re-points rows at their document positions after the shard was compacted."""
+        self.positions = [int(new_positions[pos]) for pos in self.positions]
+
+    def search(self, query_vector: List[float], k: int, n_probe: Optional[int] = None) -> List[tuple]:
+        """
+        Returns (position, score) pairs, best first. Large sessions go through the
+        IVF index, scanning n_probe lists (default ANN_NPROBE); small ones are exact.
+        Compact encodings score every candidate on the codes first, then rescore the
+        best k * RESCORE_FACTOR against the raw float32 vectors.
+        """
+        if self.live_count == 0 or k <= 0:
+            return []
+
+        q_vec = np.asarray(query_vector, dtype=np.float32)
+        q_norm = np.linalg.norm(q_vec)
+        if q_norm == 0:
+            return []
+        q_vec = q_vec / q_norm
+
+        rows = None
+        if self.ivf is not None and k < self.live_count:
+            rows = self.ivf.candidates(q_vec, n_probe or settings.ANN_NPROBE)
+            rows = rows[self.alive[rows]]
+            if len(rows) < k:
+                rows = None
+
+        if rows is None:
+            rows = np.arange(self.size)
+            scales = self.scales[:self.size] if self.scales is not None else None
+            scores = approximate_scores(self.codes[:self.size], scales, q_vec)
+            if self.dead:
+                live = self.alive[:self.size]
+                rows, scores = rows[live], scores[live]
+        else:
+            scales = self.scales[rows] if self.scales is not None else None
+            scores = approximate_scores(self.codes[rows], scales, q_vec)
+        return self._rank(rows, scores, q_vec, k)
+
+    def search_many(self, query_vectors: List[List[float]], k: int, n_probe: Optional[int] = None) -> List[List[tuple]]:
+        """
+        search() for several queries at once. Without an IVF index all of them are
+        scored in one matrix-matrix product over the codes; sessions large enough to
+        have one only probe a few lists per query, so they search query by query.
+        """
+        if self.live_count == 0 or k <= 0:
+            return [[] for _ in query_vectors]
+        if self.ivf is not None and k < self.live_count:
+            return [self.search(query_vector, k, n_probe=n_probe) for query_vector in query_vectors]
+
+        queries = normalize(np.asarray(query_vectors, dtype=np.float32))
+        rows = np.arange(self.size)
+        scales = self.scales[:self.size] if self.scales is not None else None
+        scores = approximate_scores(self.codes[:self.size], scales, queries.T)
+        if self.dead:
+            live = self.alive[:self.size]
+            rows, scores = rows[live], scores[live]
+        scores = np.ascontiguousarray(scores.T)  # one row of scores per query
+        return [
+            self._rank(rows, scores[i], q_vec, k) if q_vec.any() else []
+            for i, q_vec in enumerate(queries)
+        ]
+
+    def _rank(self, rows: np.ndarray, scores: np.ndarray, q_vec: np.ndarray, k: int) -> List[tuple]:
+        """Top k of the approximate scores; compact encodings rescore a shortlist exactly."""
+        if self.encoding == "float32":
+            return self._top_k(rows, scores, k)
+
+        shortlist = rows[self._top_k_rows(rows, scores, k * settings.RESCORE_FACTOR)]
+        raw = self.exact_vectors([self.positions[r] for r in shortlist])
+        return self._top_k(shortlist, normalize(raw) @ q_vec, k)
+
+    def _top_k_rows(self, rows: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+        if k < len(rows):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(rows))
+        # Sort by score desc, then by insertion order (stable, like list.sort)
+        return top[np.lexsort((rows[top], -scores[top]))]
+
+    def _top_k(self, rows: np.ndarray, scores: np.ndarray, k: int) -> List[tuple]:
+        top = self._top_k_rows(rows, scores, k)
+        return [(self.positions[rows[i]], float(scores[i])) for i in top]
+
+class SessionShard:
+    """
+    One session's chunks, in their own directory (STORAGE_DIR/sessions/<key>/):
+      meta.db            SQLite (WAL): chunk text and metadata, the document registry,
+                         a change log and the commit state; the commit point for everything
+      vectors-<gen>.f32  raw float32 rows, row i belongs to chunk position i
+      codes-<gen>.<enc>  normalized rows in the compact VECTOR_ENCODING (float16/int8 only)
+      scales-<gen>.f32   per-row int8 scales
+    Segments are append-only and memory-mapped; rows past the committed count are an
+    uncommitted tail and are ignored. Writers serialize on SQLite's write lock, which
+    also covers other worker processes, and every commit goes into the change log, so
+    other workers catch up on their next access by loading only what changed.
+
+    In memory, searches share `lock`; only catching up with a commit takes it
+    exclusively. Deletes only mark the document: its rows stay in the segments,
+    hidden from search, until compact() writes a new generation without them.
+    """
+    def __init__(self, directory: str, session_id: str, encoding: str, notify: Callable[[str], None]):
+        self.directory = directory
+        self.session_id = session_id
+        self.encoding = encoding
+        self.notify = notify
+        self.documents: List[Dict] = []
+        self.index = SessionIndex(encoding, self._exact_vectors)
+        self.lexical = LexicalIndex()  # BM25 over chunk text
+        self.vectors = None  # memory-mapped vectors-<gen>.f32
+        self.codes = None    # memory-mapped codes-<gen>.<enc> (compact encodings only)
+        self.scales = None
+        self.dim = None
+        self.embedding_model = None  # model the stored vectors came from
+        self.generation = 0
+        self.seq = 0  # last change log entry applied to the in-memory state
+        self.tombstones: set = set()  # positions of chunks whose document was deleted
+        self.lock = RWLock()
+        self.write_lock = threading.Lock()  # one write transaction per process, without busy-waiting
+        self.train_lock = threading.Lock()
+        self.compacting = False
+        self._memory = (None, 0)  # (state it was computed for, estimated bytes)
+        os.makedirs(directory, exist_ok=True)
+        self.meta = _Database(os.path.join(directory, "meta.db"), SHARD_SCHEMA)
+        self.load()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self.meta.db
+
+    @contextmanager
+    def _transaction(self, catch_up: bool = True):
+        """
+        Write transaction. BEGIN IMMEDIATE takes SQLite's write lock, which serializes
+        writers across processes; catching up first makes appends land after the rows
+        other workers committed.
+        """
+        with self.write_lock, self.meta.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if catch_up:
+                    self.refresh()
+                yield db
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    @property
+    def _compact(self) -> bool:
+        return self.encoding != "float32"
+
+    def _segment_paths(self, generation: int) -> List[str]:
+        """vectors, then codes and scales when the encoding has them."""
+        paths = [os.path.join(self.directory, f"vectors-{generation}.f32")]
+        if self._compact:
+            paths.append(os.path.join(self.directory, f"codes-{generation}.{self.encoding}"))
+        if self.encoding == "int8":
+            paths.append(os.path.join(self.directory, f"scales-{generation}.f32"))
+        return paths
+
+    def _arrays(self) -> List[np.ndarray]:
+        """The mapped segments, in _segment_paths() order."""
+        return [array for array in (self.vectors, self.codes, self.scales) if array is not None]
+
+    def _remove_generation(self, generation: int):
+        # Workers still mapping these files keep reading them until they reload
+        for path in glob.glob(os.path.join(self.directory, f"*-{generation}.*")):
+            os.remove(path)
+
+    def _exact_vectors(self, positions: List[int]) -> np.ndarray:
+        return np.asarray(self.vectors[positions], dtype=np.float32)
+
+    def _index_rows(self, first_position: int):
+        offsets = [
+            offset for offset in range(len(self.documents) - first_position)
+            if first_position + offset not in self.tombstones
+        ]
+        if not offsets:
+            return
+        if self._compact:
+            codes = self.codes[first_position:]
+            scales = self.scales[first_position:][offsets] if self.scales is not None else None
+        else:
+            # float32 shards hold normalized copies; nothing else is kept besides the mmap
+            codes, scales = normalize(self.vectors[first_position:]), None
+        self.index.extend(codes[offsets], scales, [first_position + o for o in offsets])
+        for offset in offsets:
+            self.lexical.add(first_position + offset, self.documents[first_position + offset]["text"])
+
+    def _rebuild_indexes(self):
+        self.index = SessionIndex(self.encoding, self._exact_vectors)
+        saved = self._saved_centroids()
+        if saved is not None:
+            # Rows only need assigning; centroids too old for the session are refit by train_ann()
+            self.index.ivf = IVFIndex.from_centroids(*saved)
+        self.lexical = LexicalIndex()
+        self._index_rows(0)
+
+    def _saved_centroids(self) -> Optional[tuple]:
+        """(centroids, rows they were fit on) saved by train_ann() for this embedding space, if any."""
+        saved = self.meta.get_state("ivf")
+        if saved is None or saved["dim"] != self.dim:
+            return None
+        try:
+            centroids = np.fromfile(os.path.join(self.directory, saved["file"]), dtype=np.float32)
+        except FileNotFoundError:
+            return None  # replaced by another worker just now
+        return centroids.reshape(-1, self.dim), saved["trained_size"]
+
+    def train_ann(self):
+        """
+        Gives a session that needs one (SessionIndex.needs_training) an IVF index. The
+        centroids are fit on a sample and the rows assigned without holding `lock`, then
+        the index is swapped in; they are saved, so page-ins and other workers only
+        assign rows. Compacting meanwhile discards the result until the next call.
+        """
+        if not self.train_lock.acquire(blocking=False):
+            return  # already running
+        try:
+            with self.lock.read():
+                index = self.index
+                if not index.needs_training:
+                    return
+                size, compactions = index.size, index.compactions
+                codes = index.codes[:size]
+                scales = index.scales[:size] if index.scales is not None else None
+
+            def decoded(rows) -> np.ndarray:
+                return decode(codes[rows], scales[rows] if scales is not None else None)
+
+            saved = self._saved_centroids()
+            if saved is not None and size <= 2 * saved[1]:
+                ivf, fitted = IVFIndex.from_centroids(*saved), False  # another worker fit them
+            else:
+                ivf, fitted = IVFIndex(n_lists=int(np.sqrt(size))), True
+                ivf.fit(decoded(ivf.sample_rows(size)), size)
+            for start in range(0, size, 4096):
+                ivf.add(decoded(slice(start, start + 4096)), start)
+
+            with self.lock.write():
+                if self.index is not index or index.compactions != compactions:
+                    return
+                if index.size > size:
+                    ivf.add(index._decoded(size, index.size), size)
+                index.ivf = ivf
+            if fitted:
+                self._save_centroids(ivf)
+        finally:
+            self.train_lock.release()
+
+    def _save_centroids(self, ivf: IVFIndex):
+        name = f"ivf-{uuid.uuid4().hex}.f32"
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(ivf.centroids.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        with self._transaction(catch_up=False):
+            previous = self.meta.get_state("ivf")
+            self.meta.set_state(ivf={"file": name, "dim": ivf.centroids.shape[1], "trained_size": ivf.trained_size})
+        if previous is not None and os.path.exists(os.path.join(self.directory, previous["file"])):
+            os.remove(os.path.join(self.directory, previous["file"]))
+
+    @STORE_SECONDS.time(operation="commit")
+    def add_many(self, texts: List[str], matrix: np.ndarray, document: Dict) -> Dict:
+        """Stores all chunks of one document and commits them together."""
+        with self._transaction():
+            self._append_rows(texts, matrix, document)
+            self._commit_document(document)
+        self.refresh()
+        return document
+
+    @STORE_SECONDS.time(operation="commit")
+    def commit_upload(self, staging: "UploadStaging") -> Dict:
+        """
+        Moves a staged upload into the shard block by block, then commits once. Rows
+        staged as reused take their vectors from the document the upload replaces,
+        which is deleted in the same commit.
+        """
+        with self._transaction() as db:
+            positions = {}
+            if staging.replaces is not None:
+                positions = dict(db.execute("SELECT id, position FROM chunks WHERE doc_id = ?", (staging.replaces,)))
+            for texts, matrix, reused in staging.iter_blocks():
+                self._append_rows(texts, self._with_reused(matrix, reused, positions), staging.document)
+            self._commit_document(staging.document)
+            if staging.replaces is not None and db.execute(
+                "UPDATE documents SET deleted = 1 WHERE id = ? AND deleted = 0", (staging.replaces,)
+            ).rowcount:
+                db.execute("INSERT INTO changes (op, doc_id) VALUES ('delete', ?)", (staging.replaces,))
+        self.refresh()
+        return staging.document
+
+    def _with_reused(self, matrix: np.ndarray, reused: List[Optional[int]], positions: Dict[int, int]) -> np.ndarray:
+        """Staged vectors with the reused rows filled in from the segments; inside the write transaction."""
+        rows = [i for i, chunk_id in enumerate(reused) if chunk_id is not None]
+        if not rows:
+            return matrix
+        if len(matrix) and matrix.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match store ({self.dim})")
+        try:
+            sources = [positions[reused[i]] for i in rows]
+        except KeyError:
+            raise ValueError("The previous version of this file was removed during the upload; upload it again")
+        full = np.empty((len(reused), self.dim), dtype=np.float32)
+        if len(matrix):
+            full[[i for i, chunk_id in enumerate(reused) if chunk_id is None]] = matrix
+        full[rows] = self.vectors[sources]
+        return full
+
+    def _append_rows(self, texts: List[str], matrix: np.ndarray, document: Dict):
+        """Writes rows past the committed tail; inside a transaction, visible once it commits."""
+        dim = self.meta.get_state("dim")
+        if dim is None:
+            dim = matrix.shape[1]
+            self.meta.set_state(dim=dim, embedding_model=settings.EMBEDDING_MODEL)
+        elif matrix.shape[1] != dim:
+            raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match store ({dim})")
+        elif self.meta.get_state("embedding_model") != settings.EMBEDDING_MODEL:
+            raise ValueError(
+                f"Session holds {self.meta.get_state('embedding_model')} embeddings, not {settings.EMBEDDING_MODEL}; "
+                "re-index it first"
+            )
+        rows = self.meta.get_state("rows", 0)
+        next_chunk_id = self.meta.get_state("next_chunk_id", 0)
+
+        codes, scales = encode(normalize(matrix), self.encoding)
+        arrays = [matrix] + ([codes] if self._compact else []) + ([scales] if scales is not None else [])
+        for path, array in zip(self._segment_paths(self.generation), arrays):
+            self._append(path, rows, array)
+
+        self.db.executemany(
+            "INSERT INTO chunks (position, id, text, source, doc_id) VALUES (?, ?, ?, ?, ?)",
+            [
+                (rows + i, next_chunk_id + i, text, document["filename"], document["id"])
+                for i, text in enumerate(texts)
+            ]
+        )
+        self.meta.set_state(rows=rows + len(texts), next_chunk_id=next_chunk_id + len(texts))
+        document["chunk_count"] += len(texts)
+
+    def _commit_document(self, document: Dict):
+        self.db.execute(
+            "INSERT INTO documents (id, filename, upload_date, chunk_count, content_hash) VALUES (?, ?, ?, ?, ?)",
+            (
+                document["id"], document["filename"], document["upload_date"], document["chunk_count"],
+                document.get("content_hash")
+            )
+        )
+        self.db.execute("INSERT INTO changes (op, doc_id) VALUES ('add', ?)", (document["id"],))
+
+    def _append(self, path: str, committed_rows: int, array: np.ndarray):
+        # Drop any uncommitted tail left by a crash or a rolled-back upload first
+        with open(path, 'ab') as f:
+            f.truncate(committed_rows * (array.nbytes // len(array)))
+            f.write(array.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def refresh(self):
+        """
+        Catches up with commits made since the last call, by this or any other worker.
+        Costs one indexed query when nothing changed.
+        """
+        # The connection is leased before `lock`, like everywhere else
+        with self.meta.connection() as db:
+            latest = db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            if latest <= self.seq:
+                return
+            with self.lock.write(), STORE_SECONDS.time(operation="catch_up"):
+                changed = self._catch_up()
+        if changed:
+            self.notify(self.session_id)
+
+    def _catch_up(self) -> bool:
+        """
+        Loads and indexes new rows and tombstones deleted documents; a compaction means
+        a full reload. Call with `lock` held for writing.
+        """
+        db = self.db
+        own_transaction = not db.in_transaction
+        if own_transaction:
+            db.execute("BEGIN")  # one consistent snapshot for the log, state and chunks
+        try:
+            changes = db.execute(
+                "SELECT seq, op, doc_id FROM changes WHERE seq > ? ORDER BY seq", (self.seq,)
+            ).fetchall()
+            if not changes:
+                return False
+            if any(op == "compact" for _, op, _ in changes):
+                self._load_snapshot()
+            else:
+                # Adds first: a delete in the same batch may refer to rows added by it
+                self._load_rows(self.meta.get_state("rows", 0))
+                for _, op, doc_id in changes:
+                    if op == "delete":
+                        self._tombstone(doc_id)
+                self.seq = changes[-1][0]
+            return True
+        finally:
+            if own_transaction:
+                db.execute("COMMIT")
+
+    def _chunk_record(self, row: tuple) -> Dict:
+        position, chunk_id, text, source, doc_id = row
+        return {"id": chunk_id, "text": text, "source": source, "session_id": self.session_id, "doc_id": doc_id}
+
+    def _load_snapshot(self):
+        db = self.db
+        self.seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        self.generation = self.meta.get_state("generation", 0)
+        self.dim = self.meta.get_state("dim")
+        self.embedding_model = self.meta.get_state("embedding_model")
+        rows = self.meta.get_state("rows", 0)
+        self.documents = [
+            self._chunk_record(row) for row in db.execute(
+                "SELECT position, id, text, source, doc_id FROM chunks WHERE position < ? ORDER BY position", (rows,)
+            )
+        ]
+        self.tombstones = {
+            position for (position,) in db.execute(
+                "SELECT c.position FROM chunks c JOIN documents d ON d.id = c.doc_id WHERE d.deleted = 1"
+            )
+        }
+        self._map_vectors()
+        self._rebuild_indexes()
+
+    def _load_rows(self, rows: int):
+        first_position = len(self.documents)
+        if rows <= first_position:
+            return
+        if self.dim is None:
+            self.dim = self.meta.get_state("dim")
+            self.embedding_model = self.meta.get_state("embedding_model")
+        self.documents.extend(
+            self._chunk_record(row) for row in self.db.execute(
+                "SELECT position, id, text, source, doc_id FROM chunks "
+                "WHERE position >= ? AND position < ? ORDER BY position", (first_position, rows)
+            )
+        )
+        self._map_vectors()
+        self._index_rows(first_position)
+
+    def _tombstone(self, doc_id: str):
+        positions = [
+            position for (position,) in self.db.execute(
+                "SELECT position FROM chunks WHERE doc_id = ? ORDER BY position", (doc_id,)
+            )
+            if position not in self.tombstones
+        ]
+        self.tombstones.update(positions)
+        self.index.kill(positions)
+        for position in positions:
+            self.lexical.remove(position, self.documents[position]["text"])
+
+    def list_documents(self) -> List[Dict]:
+        with self.meta.connection() as db:
+            return [
+                {"id": row[0], "filename": row[1], "upload_date": row[2], "chunk_count": row[3]}
+                for row in db.execute(
+                    "SELECT id, filename, upload_date, chunk_count FROM documents WHERE deleted = 0 ORDER BY rowid"
+                )
+            ]
+
+    def find_document(self, content_hash: str) -> Optional[Dict]:
+        with self.meta.connection() as db:
+            row = db.execute(
+                "SELECT id, filename, upload_date, chunk_count FROM documents "
+                "WHERE content_hash = ? AND deleted = 0 ORDER BY rowid DESC LIMIT 1", (content_hash,)
+            ).fetchone()
+        return {"id": row[0], "filename": row[1], "upload_date": row[2], "chunk_count": row[3]} if row else None
+
+    def previous_version(self, filename: str) -> tuple:
+        """
+        (document, {chunk text: chunk id}) of the latest document with this file name,
+        chunks in document order, or (None, {}).
+        """
+        with self.meta.connection() as db:
+            db.execute("BEGIN")  # the document and its chunks from one snapshot
+            row = db.execute(
+                "SELECT id, filename, upload_date, chunk_count FROM documents "
+                "WHERE filename = ? AND deleted = 0 ORDER BY rowid DESC LIMIT 1", (filename,)
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None, {}
+            document = {"id": row[0], "filename": row[1], "upload_date": row[2], "chunk_count": row[3]}
+            chunks = {text: chunk_id for chunk_id, text in db.execute(
+                "SELECT id, text FROM chunks WHERE doc_id = ? ORDER BY position", (row[0],)
+            )}
+            db.execute("COMMIT")
+        return document, chunks
+
+    def _check_space(self, query_dim: int):
+        """Refuses to score queries against vectors from another embedding space."""
+        if self.dim is None:
+            return  # nothing stored yet
+        if self.embedding_model != settings.EMBEDDING_MODEL or query_dim != self.dim:
+            raise EmbeddingSpaceError(
+                f"This session was indexed with {self.embedding_model} ({self.dim} dimensions) but queries use "
+                f"{settings.EMBEDDING_MODEL} ({query_dim} dimensions); it needs to be re-indexed"
+            )
+
+    def search(self, query_vector: List[float], k: int, n_probe: Optional[int] = None) -> List[Dict]:
+        self.refresh()
+        with self.lock.read():
+            self._check_space(len(query_vector))
+            return [
+                {"doc": self.documents[position], "score": score}
+                for position, score in self.index.search(query_vector, k, n_probe=n_probe)
+            ]
+
+    def search_many(self, query_vectors: List[List[float]], k: int, n_probe: Optional[int] = None) -> List[List[Dict]]:
+        self.refresh()
+        with self.lock.read():
+            self._check_space(len(query_vectors[0]) if len(query_vectors) else self.dim)
+            return [
+                [{"doc": self.documents[position], "score": score} for position, score in ranking]
+                for ranking in self.index.search_many(query_vectors, k, n_probe=n_probe)
+            ]
+
+    def lexical_search(self, query: str, k: int) -> List[Dict]:
+        self.refresh()
+        with self.lock.read():
+            return [
+                {"doc": self.documents[position], "score": score}
+                for position, score in self.lexical.search(query, k)
+            ]
+
+    def hybrid_search(self, query: str, query_vector: List[float], k: int,
+                      n_probe: Optional[int] = None) -> List[Dict]:
+        self.refresh()
+        candidates = k * settings.HYBRID_CANDIDATE_FACTOR
+        with self.lock.read():
+            self._check_space(len(query_vector))
+            fused = reciprocal_rank_fusion(
+                [
+                    self.index.search(query_vector, candidates, n_probe=n_probe),
+                    self.lexical.search(query, candidates)
+                ],
+                k,
+                c=settings.RRF_K
+            )
+            return [{"doc": self.documents[position], "score": score} for position, score in fused]
+
+    def hybrid_search_many(self, queries: List[str], query_vectors: List[List[float]], k: int,
+                           n_probe: Optional[int] = None) -> List[List[Dict]]:
+        self.refresh()
+        candidates = k * settings.HYBRID_CANDIDATE_FACTOR
+        with self.lock.read():
+            self._check_space(len(query_vectors[0]) if len(query_vectors) else self.dim)
+            vector_rankings = self.index.search_many(query_vectors, candidates, n_probe=n_probe)
+            results = []
+            for query, vector_ranking in zip(queries, vector_rankings):
+                fused = reciprocal_rank_fusion(
+                    [vector_ranking, self.lexical.search(query, candidates)], k, c=settings.RRF_K
+                )
+                results.append([{"doc": self.documents[position], "score": score} for position, score in fused])
+            return results
+
+    @STORE_SECONDS.time(operation="delete")
+    def delete_document(self, doc_id: str) -> bool:
+        with self._transaction() as db:
+            deleted = db.execute(
+                "UPDATE documents SET deleted = 1 WHERE id = ? AND deleted = 0", (doc_id,)
+            ).rowcount
+            if deleted:
+                db.execute("INSERT INTO changes (op, doc_id) VALUES ('delete', ?)", (doc_id,))
+        if not deleted:
+            return False
+        self.refresh()
+        return True
+
+    def memory_bytes(self) -> int:
+        """
+        Rough RAM held by this shard: index codes, chunk records and text, BM25
+        postings (about 64 bytes each with their search arrays) and the SQLite page
+        caches. Recomputed only after the shard changed, except for the caches.
+        """
+        with self.lock.read():
+            state = (len(self.documents), self.index.size, len(self.lexical), self.generation)
+            if self._memory[0] != state:
+                index = self.index
+                arrays = sum(a.nbytes for a in (index.codes, index.scales, index.alive) if a is not None)
+                text = sum(len(doc["text"]) for doc in self.documents)
+                postings = sum(len(positions) for positions in self.lexical.postings.values())
+                self._memory = (state, arrays + text + len(self.documents) * 400 + postings * 64)
+            return self._memory[1] + self.meta.cache_bytes()
+
+    def close(self):
+        """Closes the shard's SQLite connections once evicted; searches still running on it can finish."""
+        self.meta.close()
+
+    @property
+    def tombstone_ratio(self) -> float:
+        return len(self.tombstones) / len(self.documents) if self.documents else 0.0
+
+    @STORE_SECONDS.time(operation="compact")
+    def compact(self):
+        """
+        Writes a new generation of segments without tombstoned rows. The bulk copy of
+        the rows committed so far runs without any lock; rows appended or deleted
+        meanwhile, by any worker, are reconciled under the write lock before the new
+        generation is committed.
+        """
+        self.refresh()
+        with self.lock.read():
+            if self.compacting or not self.tombstones:
+                return
+            self.compacting = True
+            generation = self.generation
+            snapshot_rows = len(self.documents)
+            keep = [pos for pos in range(snapshot_rows) if pos not in self.tombstones]
+            arrays = self._arrays()
+        temp_paths = [f"{path}.{uuid.uuid4().hex}.tmp" for path in self._segment_paths(generation + 1)]
+        changed = False
+        try:
+            _write_rows(list(zip(temp_paths, arrays)), keep, 'wb')
+
+            with self.write_lock, self.meta.connection() as db:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    with self.lock.write():
+                        changed = self._catch_up()
+                        if self.generation == generation:  # else another worker compacted first
+                            self._swap_generation(db, temp_paths, snapshot_rows, keep)
+                    if db.in_transaction:
+                        db.execute("ROLLBACK")
+                except BaseException:
+                    if db.in_transaction:
+                        db.execute("ROLLBACK")
+                    raise
+            if self.generation != generation:
+                self._remove_generation(generation)
+        finally:
+            self.compacting = False
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        if changed:
+            self.notify(self.session_id)
+
+    def _swap_generation(self, db: sqlite3.Connection, temp_paths: List[str], snapshot_rows: int, keep: List[int]):
+        """Second half of compact(): inside the write transaction, with `lock` held for writing."""
+        # Rows committed while the copy ran are appended as-is
+        tail = list(range(snapshot_rows, len(self.documents)))
+        _write_rows(list(zip(temp_paths, self._arrays())), tail, 'ab')
+        order = keep + tail
+
+        new_positions = np.full(len(self.documents), -1, dtype=np.int64)
+        new_positions[order] = np.arange(len(order))
+        db.executemany(
+            "DELETE FROM chunks WHERE position = ?",
+            [(int(pos),) for pos in np.flatnonzero(new_positions < 0)]
+        )
+        # Ascending, so each target position has already been vacated
+        db.executemany(
+            "UPDATE chunks SET position = ? WHERE position = ?",
+            [(new, old) for new, old in enumerate(order) if new != old]
+        )
+        db.execute(
+            "DELETE FROM documents WHERE deleted = 1 AND NOT EXISTS "
+            "(SELECT 1 FROM chunks c WHERE c.doc_id = documents.id)"
+        )
+        # Readers behind this point have to reload anyway, so the log can start over
+        db.execute("DELETE FROM changes")
+        seq = db.execute("INSERT INTO changes (op) VALUES ('compact')").lastrowid
+        self.meta.set_state(generation=self.generation + 1, rows=len(order))
+        for temp_path, path in zip(temp_paths, self._segment_paths(self.generation + 1)):
+            os.replace(temp_path, path)
+        db.execute("COMMIT")
+
+        self.seq = seq
+        self.generation += 1
+        self.documents = [self.documents[pos] for pos in order]
+        self.tombstones = {int(new_positions[pos]) for pos in self.tombstones if new_positions[pos] >= 0}
+        self.index.compact()
+        self.index.remap(new_positions)
+        self.lexical.remap(new_positions)
+        self._map_vectors()
+
+    def _map_vectors(self):
+        rows = len(self.documents)
+        self.codes, self.scales = None, None
+        if not rows:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+            return
+        paths = self._segment_paths(self.generation)
+        self.vectors = np.memmap(paths[0], dtype=np.float32, mode='r', shape=(rows, self.dim))
+        if not self._compact:
+            return
+        self.codes = np.memmap(paths[1], dtype=self.encoding, mode='r', shape=(rows, self.dim))
+        if self.encoding == "int8":
+            self.scales = np.memmap(paths[2], dtype=np.float32, mode='r', shape=(rows,))
+
+    @STORE_SECONDS.time(operation="load")
+    def load(self):
+        if self.meta.get_state("format") is None:
+            with self._transaction(catch_up=False):
+                if self.meta.get_state("format") is None:  # else another worker got here first
+                    self.meta.set_state(format=STORAGE_FORMAT, session_id=self.session_id,
+                                        encoding=self.encoding, generation=0, rows=0, next_chunk_id=0)
+        else:
+            if self.meta.get_state("encoding") != self.encoding:
+                self._reencode()
+            if "content_hash" not in self._document_columns():
+                with self._transaction(catch_up=False) as db:
+                    if "content_hash" not in self._document_columns():
+                        db.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+            if self.meta.get_state("dim") is not None and self.meta.get_state("embedding_model") is None:
+                # Shards from before the model was recorded hold the configured model's vectors
+                with self._transaction(catch_up=False):
+                    self.meta.set_state(embedding_model=settings.EMBEDDING_MODEL)
+        with self.meta.connection() as db, self.lock.write():
+            db.execute("BEGIN")
+            try:
+                self._load_snapshot()
+            finally:
+                db.execute("COMMIT")
+
+    def _document_columns(self) -> set:
+        with self.meta.connection() as db:
+            return {row[1] for row in db.execute("PRAGMA table_info(documents)")}
+
+    def _import(self, chunks: List[Dict], vectors: np.ndarray, documents: List[Dict]):
+        """Writes migrated chunks, their vectors and documents as generation 1 of a new shard."""
+        with self._transaction(catch_up=False) as db:
+            db.executemany(
+                "INSERT INTO chunks (position, id, text, source, doc_id) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (position, chunk["id"], chunk["text"], chunk["source"], chunk["doc_id"])
+                    for position, chunk in enumerate(chunks)
+                ]
+            )
+            db.executemany(
+                "INSERT INTO documents (id, filename, upload_date, chunk_count, deleted) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (d["id"], d["filename"], d["upload_date"], d["chunk_count"], int(d["deleted"]))
+                    for d in documents
+                ]
+            )
+            codes, scales = encode(normalize(vectors), self.encoding)
+            arrays = [vectors] + ([codes] if self._compact else []) + ([scales] if scales is not None else [])
+            for path, array in zip(self._segment_paths(1), arrays):
+                self._append(path, 0, array)
+            self.meta.set_state(
+                generation=1,
+                dim=vectors.shape[1],
+                embedding_model=settings.EMBEDDING_MODEL,
+                rows=len(chunks),
+                next_chunk_id=max(chunk["id"] for chunk in chunks) + 1
+            )
+            db.execute("INSERT INTO changes (op) VALUES ('compact')")
+        self.refresh()
+
+    def _reencode(self):
+        """Writes a new generation of compact segments after VECTOR_ENCODING changes."""
+        with self._transaction(catch_up=False) as db:
+            if self.meta.get_state("encoding") == self.encoding:
+                return  # another worker got here first
+            generation = self.meta.get_state("generation", 0)
+            rows = self.meta.get_state("rows", 0)
+            dim = self.meta.get_state("dim")
+            print(f"Re-encoding {rows} vectors of session shard {self.directory} as {self.encoding}")
+            if rows:
+                vectors = np.fromfile(
+                    os.path.join(self.directory, f"vectors-{generation}.f32"), dtype=np.float32, count=rows * dim
+                ).reshape(rows, dim)
+                codes, scales = encode(normalize(vectors), self.encoding)
+                arrays = [vectors] + ([codes] if self._compact else []) + ([scales] if scales is not None else [])
+                for path, array in zip(self._segment_paths(generation + 1), arrays):
+                    self._append(path, 0, array)
+            db.execute("DELETE FROM changes")
+            db.execute("INSERT INTO changes (op) VALUES ('compact')")
+            self.meta.set_state(encoding=self.encoding, generation=generation + 1)
+        self._remove_generation(generation)
+
+    def replace_vectors(self, vectors: np.ndarray, embedding_model: str, rows: int, generation: int):
+        """
+        Moves the shard into another embedding space (used by app.reindex): `vectors`
+        replace all `rows` committed rows as a new generation. Fails if anything was
+        committed or compacted since `rows` and `generation` were read.
+        """
+        with self._transaction(catch_up=False) as db:
+            if (self.meta.get_state("rows", 0), self.meta.get_state("generation", 0)) != (rows, generation):
+                raise RuntimeError("Session changed during re-indexing; run again to resume")
+            codes, scales = encode(normalize(vectors), self.encoding)
+            arrays = [vectors] + ([codes] if self._compact else []) + ([scales] if scales is not None else [])
+            for path, array in zip(self._segment_paths(generation + 1), arrays):
+                self._append(path, 0, array)
+            db.execute("DELETE FROM changes")
+            db.execute("INSERT INTO changes (op) VALUES ('compact')")
+            # Centroids fit in the old embedding space are useless in the new one
+            self.meta.set_state(dim=vectors.shape[1], embedding_model=embedding_model, generation=generation + 1, ivf=None)
+        self._remove_generation(generation)
+        self.refresh()
 
 class SimpleVectorStore:
+    """
+    Session-sharded store. Every session is a SessionShard with its own directory,
+    lock and files, so work in different sessions never contends, and a delete
+    touches only its own shard. STORAGE_DIR/store.db holds what is not per session
+    (the format marker and ingestion job status).
+
+    Shards are paged in on first access, by this or any worker, and kept in LRU
+    order; once the resident ones pass STORE_MEMORY_BUDGET_MB the least recently
+    used are dropped from memory. Their files stay, so they page back in when next
+    used. Searches already running on an evicted shard finish on their reference.
+    """
     def __init__(self):
-        self.documents: List[Dict] = []
-        self.storage_file = settings.STORAGE_FILE
+        self.encoding = settings.VECTOR_ENCODING
+        self.storage_dir = settings.STORAGE_DIR
+        self.storage_file = settings.STORAGE_FILE  # legacy JSON, migrated on first start
+        self.shards: "OrderedDict[str, SessionShard]" = OrderedDict()  # least recently used first
+        self.shards_lock = threading.Lock()
+        self.opening: Dict[str, threading.Lock] = {}  # one page-in per session at a time
+        self.memory_budget = settings.STORE_MEMORY_BUDGET_MB * 1024 * 1024
+        self.page_ins = 0
+        self.evictions = 0
+        self.listeners: List[Callable[[str], None]] = []
+        os.makedirs(self.storage_dir, exist_ok=True)
+        self.meta = _Database(os.path.join(self.storage_dir, "store.db"), STORE_SCHEMA)
         self.load()
 
-    def add(self, text: str, vector: List[float], source: str, session_id: str):
-        doc = {
-            "id": len(self.documents),
-            "text": text,
-            "vector": vector,
-            "source": source,
-            "session_id": session_id
+    def add_listener(self, callback: Callable[[str], None]):
+        """Registers callback(session_id), called whenever a session's corpus changes."""
+        self.listeners.append(callback)
+
+    def _notify(self, session_id: str):
+        for callback in self.listeners:
+            callback(session_id)
+
+    @property
+    def _shards_dir(self):
+        return os.path.join(self.storage_dir, "sessions")
+
+    def _shard_dir(self, session_id: str) -> str:
+        # Session ids come from a request header, so they never become paths directly
+        return os.path.join(self._shards_dir, hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32])
+
+    def _resident(self, session_id: str) -> Optional[SessionShard]:
+        with self.shards_lock:
+            shard = self.shards.get(session_id)
+            if shard is not None:
+                self.shards.move_to_end(session_id)
+            return shard
+
+    def shard(self, session_id: str, create: bool = False) -> Optional[SessionShard]:
+        shard = self._resident(session_id)
+        if shard is not None:
+            return shard
+        with self.shards_lock:
+            opening = self.opening.setdefault(session_id, threading.Lock())
+        # Paging in reads the whole shard, so only this session waits for it
+        with opening:
+            shard = self._resident(session_id)
+            if shard is not None:
+                return shard
+            try:
+                directory = self._shard_dir(session_id)
+                if not create and not os.path.exists(os.path.join(directory, "meta.db")):
+                    return None
+                shard = SessionShard(directory, session_id, self.encoding, self._notify)
+                with self.shards_lock:
+                    self.shards[session_id] = shard
+                    self.page_ins += 1
+                SESSION_PAGE_INS.inc()
+            finally:
+                with self.shards_lock:
+                    self.opening.pop(session_id, None)
+        self._evict()
+        return shard
+
+    def _evict(self):
+        """Drops least recently used shards until the rest fit the memory budget; the latest always stays."""
+        if not self.memory_budget:
+            return
+        with self.shards_lock:
+            shards = list(self.shards.items())
+        sizes = {session_id: shard.memory_bytes() for session_id, shard in shards}
+        resident = sum(sizes.values())
+        with self.shards_lock:
+            for session_id, _ in shards[:-1]:
+                if resident <= self.memory_budget:
+                    break
+                shard = self.shards.pop(session_id, None)
+                if shard is not None:
+                    shard.close()
+                    resident -= sizes[session_id]
+                    self.evictions += 1
+                    SESSION_EVICTIONS.inc()
+
+    def residency_stats(self) -> Dict:
+        with self.shards_lock:
+            shards = list(self.shards.values())
+        return {
+            "resident_sessions": len(shards),
+            "resident_bytes": sum(shard.memory_bytes() for shard in shards),
+            "memory_budget_bytes": self.memory_budget,
+            "page_ins": self.page_ins,
+            "evictions": self.evictions
         }
-        self.documents.append(doc)
-        self.save()
 
-    def search(self, query_vector: List[float], session_id: str, k: int = 3) -> List[Dict]:
-        if not self.documents:
-            return []
+    def session_stats(self) -> Dict[str, Dict]:
+        """Size of every resident shard, keyed by its directory name rather than the raw session id."""
+        stats = {}
+        with self.shards_lock:
+            shards = list(self.shards.values())
+        for shard in shards:
+            rows = len(shard.documents)
+            stats[os.path.basename(shard.directory)] = {
+                "chunks": rows - len(shard.tombstones),
+                "tombstoned_chunks": len(shard.tombstones),
+                "vector_bytes": rows * bytes_per_vector(shard.dim or 0, self.encoding)
+            }
+        return stats
 
+    def memory_per_chunk(self) -> int:
+        """Bytes of vector data each chunk keeps resident in RAM."""
+        with self.shards_lock:
+            dim = max((shard.dim or 0 for shard in self.shards.values()), default=0)
+        return bytes_per_vector(dim, self.encoding)
+
+    def add(self, text: str, vector: List[float], source: str, session_id: str) -> Dict:
+        return self.add_many([text], [vector], source, session_id)
+
+    def add_many(self, texts: List[str], vectors: List[List[float]], source: str, session_id: str) -> Dict:
+        """Stores all chunks of one document and commits them together."""
+        shard = self.shard(session_id, create=True)
+        document = shard.add_many(texts, np.asarray(vectors, dtype=np.float32), new_document(source, session_id))
+        self._evict()
+        self._train_ann(shard)
+        return document
+
+    def find_document(self, content_hash: str, session_id: str) -> Optional[Dict]:
+        """The session's document uploaded with exactly this content, if any."""
+        shard = self.shard(session_id)
+        return shard.find_document(content_hash) if shard is not None else None
+
+    def previous_version(self, filename: str, session_id: str) -> tuple:
+        """
+        The session's latest document with this file name, as (document, {chunk text:
+        chunk id}); an upload that replaces it can reuse the vectors of those chunks.
+        """
+        shard = self.shard(session_id)
+        return shard.previous_version(filename) if shard is not None else (None, {})
+
+    def stage_upload(self, source: str, session_id: str, content_hash: Optional[str] = None,
+                     replaces: Optional[str] = None) -> "UploadStaging":
+        """
+        Starts an upload whose chunks are spooled to disk until commit_upload(). The
+        document `replaces` is deleted when it commits.
+        """
+        return UploadStaging(
+            os.path.join(self.storage_dir, "staging"), new_document(source, session_id, content_hash), replaces
+        )
+
+    def commit_upload(self, staging: "UploadStaging") -> Dict:
+        """Moves a staged upload into its session's shard and commits it."""
+        shard = self.shard(staging.document["session_id"], create=True)
+        try:
+            document = shard.commit_upload(staging)
+        finally:
+            staging.discard()
+        self._evict()
+        self._train_ann(shard)
+        return document
+
+    def _train_ann(self, shard: SessionShard):
+        # On the writer's thread, so searches never wait for k-means; the compactor retries failures
+        try:
+            shard.train_ann()
+        except Exception:
+            logger.exception(f"IVF training for session shard {shard.directory} failed")
+
+    def list_documents(self, session_id: str) -> List[Dict]:
+        shard = self.shard(session_id)
+        return shard.list_documents() if shard is not None else []
+
+    def search(self, query_vector: List[float], session_id: str, k: int = 3,
+               n_probe: Optional[int] = None) -> List[Dict]:
         # Filter by session_id first (Retreival Safety)
-        # Ignores legacy documents without session_id
-        user_docs = [doc for doc in self.documents if doc.get("session_id") == session_id]
-        
-        if not user_docs:
+        shard = self.shard(session_id)
+        if shard is None:
             return []
+        return shard.search(query_vector, k, n_probe=n_probe)
 
-        q_vec = np.array(query_vector)
-        q_norm = np.linalg.norm(q_vec)
-        if q_norm == 0:
+    def search_many(self, query_vectors: List[List[float]], session_id: str, k: int = 3,
+                    n_probe: Optional[int] = None) -> List[List[Dict]]:
+        """search() for many queries in one session, scored together in one matrix product."""
+        shard = self.shard(session_id)
+        if shard is None:
+            return [[] for _ in query_vectors]
+        return shard.search_many(query_vectors, k, n_probe=n_probe)
+
+    def lexical_search(self, query: str, session_id: str, k: int = 3) -> List[Dict]:
+        """BM25 keyword search; needs no query embedding."""
+        shard = self.shard(session_id)
+        if shard is None:
             return []
-        
-        results = []
-        for doc in user_docs:
-            d_vec = np.array(doc["vector"])
-            d_norm = np.linalg.norm(d_vec)
-            
-            if d_norm == 0:
-                score = 0
-            else:
-                score = np.dot(q_vec, d_vec) / (q_norm * d_norm)
-            
-            results.append({
-                "doc": doc,
-                "score": float(score)
-            })
-        
-        results.sort(key=lambda x: x["score"], reverse=True)
-        return results[:k]
+        return shard.lexical_search(query, k)
 
-    def save(self):
-        with open(self.storage_file, 'w') as f:
-            json.dump(self.documents, f)
+    def hybrid_search(self, query: str, query_vector: List[float], session_id: str, k: int = 3,
+                      n_probe: Optional[int] = None) -> List[Dict]:
+        """
+        Vector and BM25 rankings fused by reciprocal rank fusion; each side contributes
+        its top k * HYBRID_CANDIDATE_FACTOR. Scores are the fused RRF scores.
+        """
+        shard = self.shard(session_id)
+        if shard is None:
+            return []
+        return shard.hybrid_search(query, query_vector, k, n_probe=n_probe)
+
+    def hybrid_search_many(self, queries: List[str], query_vectors: List[List[float]], session_id: str,
+                           k: int = 3, n_probe: Optional[int] = None) -> List[List[Dict]]:
+        """hybrid_search() for many queries; the vector side is one matrix product."""
+        shard = self.shard(session_id)
+        if shard is None:
+            return [[] for _ in queries]
+        return shard.hybrid_search_many(queries, query_vectors, k, n_probe=n_probe)
+
+    def delete_document(self, doc_id: str, session_id: str):
+        """Tombstones all segments associated with a doc_id if session_id matches."""
+        shard = self.shard(session_id)
+        if shard is None:
+            return False
+        return shard.delete_document(doc_id)
+
+    def publish_job(self, job_id: str, session_id: str, data: Dict):
+        """Shares ingestion job status, so any worker can answer a status poll."""
+        now = time.time()
+        with self.meta.connection() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO jobs (id, session_id, data, updated) VALUES (?, ?, ?, ?)",
+                (job_id, session_id, json.dumps(data), now)
+            )
+            db.execute("DELETE FROM jobs WHERE updated < ?", (now - settings.INGEST_JOB_RETENTION_SECONDS,))
+
+    def touch_jobs(self, job_ids: List[str]):
+        """Marks jobs the calling worker is still running as alive; see fail_stale_jobs()."""
+        now = time.time()
+        with self.meta.connection() as db:
+            db.executemany("UPDATE jobs SET updated = ? WHERE id = ?", [(now, job_id) for job_id in job_ids])
+
+    def fail_stale_jobs(self, cutoff: float, error: str) -> int:
+        """Fails queued or processing jobs not updated since `cutoff`: the worker running them is gone."""
+        with self.meta.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                stale = []
+                for job_id, data in db.execute("SELECT id, data FROM jobs WHERE updated < ?", (cutoff,)).fetchall():
+                    job = json.loads(data)
+                    if job["status"] in ("queued", "processing"):
+                        job.update(status="failed", error=error)
+                        stale.append((json.dumps(job), job_id))
+                db.executemany("UPDATE jobs SET data = ? WHERE id = ?", stale)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return len(stale)
+
+    def get_job(self, job_id: str, session_id: str) -> Optional[Dict]:
+        with self.meta.connection() as db:
+            row = db.execute(
+                "SELECT data FROM jobs WHERE id = ? AND session_id = ?", (job_id, session_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def run_compactor(self):
+        """
+        Background task: compacts resident shards whose tombstones pass
+        COMPACTION_THRESHOLD, and fits IVF indexes for the ones that need them. Evicted
+        shards are seen to once they are paged back in.
+        """
+        while True:
+            await asyncio.sleep(settings.COMPACTION_INTERVAL_SECONDS)
+            with self.shards_lock:
+                shards = list(self.shards.values())
+            for shard in shards:
+                if shard.tombstone_ratio >= settings.COMPACTION_THRESHOLD:
+                    try:
+                        await asyncio.to_thread(shard.compact)
+                    except Exception:
+                        logger.exception(f"Compaction of session shard {shard.directory} failed")
+                if shard.index.needs_training:
+                    try:
+                        await asyncio.to_thread(shard.train_ann)
+                    except Exception:
+                        logger.exception(f"IVF training for session shard {shard.directory} failed")
 
     def load(self):
-        if os.path.exists(self.storage_file):
+        """Creates or migrates the store; session shards are only paged in when used."""
+        try:
+            if self.meta.get_state("format") is None:
+                self._initialize()
+        except Exception as e:
+            print(f"Error loading storage: {e}")
+
+    def _initialize(self):
+        """Creates the store, splitting older single-file layouts into session shards."""
+        legacy_db = os.path.join(self.storage_dir, "meta.db")
+        manifest_path = os.path.join(self.storage_dir, "manifest.json")
+        with self.meta.connection() as db:
+            db.execute("BEGIN IMMEDIATE")  # also keeps other workers out of the migration
             try:
-                with open(self.storage_file, 'r') as f:
-                    self.documents = json.load(f)
-            except Exception as e:
-                print(f"Error loading storage: {e}")
-                self.documents = []
+                if self.meta.get_state("format") is None:
+                    if os.path.exists(legacy_db):
+                        self._import_shards(*_read_meta_db(self.storage_dir))
+                    elif os.path.exists(manifest_path):
+                        self._import_shards(*_read_manifest(self.storage_dir))
+                    elif os.path.exists(self.storage_file):
+                        self._import_shards(*_read_json(self.storage_file))
+                    self.meta.set_state(format=STORAGE_FORMAT)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
 
-    def delete_document(self, doc_id: str, session_id: str):
-        """Removes all segments associated with a doc_id if session_id matches."""
-        initial_count = len(self.documents)
-        # doc_id was stored in metadata in previous version, let's look both places for safety
-        self.documents = [
-            doc for doc in self.documents 
-            if not (
-                (doc.get("session_id") == session_id) and 
-                (str(doc.get("id")) == doc_id or doc.get("metadata", {}).get("doc_id") == doc_id)
+        # The old single-file layouts have been copied into the shards
+        for pattern in ("meta.db*", "vectors*.f32", "codes*", "scales*.f32",
+                        "chunks.jsonl", "documents.jsonl", "manifest.json"):
+            for path in glob.glob(os.path.join(self.storage_dir, pattern)):
+                os.remove(path)
+
+    def _import_shards(self, chunks: List[Dict], vectors: np.ndarray, documents: Dict[tuple, Dict]):
+        """
+        Splits migrated chunks by session into new shards. Chunks from before the registry
+        existed become one document per file name; chunks without a session were never
+        searchable and are dropped.
+        """
+        by_session: Dict[str, List[int]] = {}
+        for position, chunk in enumerate(chunks):
+            session_id = chunk.get("session_id")
+            if session_id is None:
+                continue
+            chunk["doc_id"] = chunk.get("doc_id") or chunk["source"]
+            by_session.setdefault(session_id, []).append(position)
+            document = documents.setdefault((session_id, chunk["doc_id"]), {
+                "id": chunk["doc_id"],
+                "filename": chunk["source"],
+                "upload_date": "Recent",
+                "deleted": False
+            })
+            document["chunk_count"] = document.get("chunk_count", 0) + 1
+
+        print(f"Migrating {len(chunks)} chunks into {len(by_session)} session shards")
+        for session_id, positions in by_session.items():
+            shard = SessionShard(self._shard_dir(session_id), session_id, self.encoding, self._notify)
+            shard._import(
+                [chunks[pos] for pos in positions],
+                np.asarray(vectors[positions], dtype=np.float32),
+                [d for (sid, _), d in documents.items() if sid == session_id and d.get("chunk_count")]
             )
-        ]
-        if len(self.documents) < initial_count:
-            self.save()
-            return True
-        return False
+            shard.close()
+
+def _read_meta_db(storage_dir: str) -> tuple:
+    """Chunks, vectors and documents of the single meta.db layout (format 2)."""
+    db = sqlite3.connect(os.path.join(storage_dir, "meta.db"))
+    state = {key: json.loads(value) for key, value in db.execute("SELECT key, value FROM state")}
+    rows, dim = state.get("rows", 0), state.get("dim") or 0
+    chunks = [
+        {"id": row[0], "text": row[1], "source": row[2], "session_id": row[3], "doc_id": row[4]}
+        for row in db.execute(
+            "SELECT id, text, source, session_id, doc_id FROM chunks WHERE position < ? ORDER BY position", (rows,)
+        )
+    ]
+    documents = {
+        (row[0], row[1]): {"id": row[1], "filename": row[2], "upload_date": row[3], "deleted": bool(row[4])}
+        for row in db.execute("SELECT session_id, id, filename, upload_date, deleted FROM documents")
+    }
+    db.close()
+    vectors = np.fromfile(
+        os.path.join(storage_dir, f"vectors-{state.get('generation', 0)}.f32"), dtype=np.float32, count=rows * dim
+    ).reshape(rows, dim) if rows else np.zeros((0, dim), dtype=np.float32)
+    return chunks, vectors, documents
+
+def _read_manifest(storage_dir: str) -> tuple:
+    """Chunks, vectors and documents of the chunks.jsonl / documents.jsonl / manifest.json layout."""
+    with open(os.path.join(storage_dir, "manifest.json"), 'r') as f:
+        manifest = json.load(f)
+    rows, dim = manifest["rows"], manifest["dim"] or 0
+    with open(os.path.join(storage_dir, "chunks.jsonl"), 'rb') as f:
+        chunks = [json.loads(line) for line in f.read(manifest["log_bytes"]).splitlines()][:rows]
+
+    documents = {}
+    if manifest.get("registry_bytes"):
+        with open(os.path.join(storage_dir, "documents.jsonl"), 'rb') as f:
+            for line in f.read(manifest["registry_bytes"]).splitlines():
+                record = json.loads(line)
+                key = (record["session_id"], record["id"])
+                if record.get("op") == "delete":
+                    documents[key]["deleted"] = True
+                else:
+                    documents[key] = {
+                        "id": record["id"],
+                        "filename": record["filename"],
+                        "upload_date": record["upload_date"],
+                        "deleted": False
+                    }
+    vectors = np.fromfile(
+        os.path.join(storage_dir, "vectors.f32"), dtype=np.float32, count=rows * dim
+    ).reshape(rows, dim)
+    return chunks, vectors, documents
+
+def _read_json(storage_file: str) -> tuple:
+    """Chunks and vectors of the original storage.json."""
+    with open(storage_file, 'r') as f:
+        legacy = json.load(f)
+    chunks = [{key: value for key, value in doc.items() if key != "vector"} for doc in legacy]
+    vectors = np.asarray([doc["vector"] for doc in legacy], dtype=np.float32)
+    return chunks, vectors, {}
+
+def _write_rows(targets: List[tuple], positions: List[int], mode: str, block_rows: int = 4096):
+    """Copies the given rows of each source array into its target file."""
+    for path, array in targets:
+        with open(path, mode) as f:
+            for start in range(0, len(positions), block_rows):
+                f.write(np.ascontiguousarray(array[positions[start:start + block_rows]]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+def new_document(filename: str, session_id: str, content_hash: Optional[str] = None) -> Dict:
+    return {
+        "id": uuid.uuid4().hex,
+        "session_id": session_id,
+        "filename": filename,
+        "upload_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "chunk_count": 0,
+        "content_hash": content_hash
+    }
+
+class UploadStaging:
+    """
+    Spools one upload's chunk texts and vectors to temporary files, so an upload
+    only holds one embedding batch in memory and nothing is visible until commit.
+    Chunks unchanged from the document the upload replaces are spooled with that
+    chunk's id instead of a vector.
+    """
+    def __init__(self, staging_dir: str, document: Dict, replaces: Optional[str] = None):
+        os.makedirs(staging_dir, exist_ok=True)
+        base = os.path.join(staging_dir, uuid.uuid4().hex)
+        self.document = document
+        self.replaces = replaces
+        self.embedded = 0  # rows in the vectors file
+        self.count = 0
+        self.dim = None
+        self.texts_path = base + ".jsonl"
+        self.vectors_path = base + ".f32"
+        self.texts_file = open(self.texts_path, 'w', encoding="utf-8")
+        self.vectors_file = open(self.vectors_path, 'wb')
+
+    def add(self, texts: List[str], vectors: List[List[float]], reused: Optional[List[Optional[int]]] = None):
+        """`vectors` has one row per text whose `reused` chunk id is None (all of them by default)."""
+        reused = reused or [None] * len(texts)
+        if len(vectors):
+            # Row by row: one np.asarray over the whole window holds the GIL for tens of milliseconds
+            matrix = np.empty((len(vectors), len(vectors[0])), dtype=np.float32)
+            for i, vector in enumerate(vectors):
+                matrix[i] = vector
+            self.dim = matrix.shape[1]
+            self.vectors_file.write(matrix.tobytes())
+            self.embedded += len(matrix)
+        for text, chunk_id in zip(texts, reused):
+            self.texts_file.write(json.dumps([text, chunk_id]) + "\n")
+        self.count += len(texts)
+
+    def iter_blocks(self, block_rows: int = 1024):
+        """Yields (texts, vectors of the embedded ones, reused chunk id or None per text)."""
+        self.texts_file.close()
+        self.vectors_file.close()
+        if not self.count:
+            return
+        vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.embedded, self.dim)) \
+            if self.embedded else np.zeros((0, self.dim or 0), dtype=np.float32)
+        embedded = 0
+        with open(self.texts_path, 'r', encoding="utf-8") as f:
+            for start in range(0, self.count, block_rows):
+                rows = [json.loads(f.readline()) for _ in range(min(block_rows, self.count - start))]
+                new = sum(1 for _, chunk_id in rows if chunk_id is None)
+                yield [text for text, _ in rows], np.asarray(vectors[embedded:embedded + new]), \
+                    [chunk_id for _, chunk_id in rows]
+                embedded += new
+        del vectors
+
+    def discard(self):
+        self.texts_file.close()
+        self.vectors_file.close()
+        for path in (self.texts_path, self.vectors_path):
+            if os.path.exists(path):
+                os.remove(path)
 
 # Global instance
 vector_store = SimpleVectorStore()
@@ -1,43 +1,155 @@
+import codecs
 import re
+from bisect import bisect_left, bisect_right
+from typing import BinaryIO, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+_WHITESPACE = re.compile(r'\s+')
+
+def _collapse(match: re.Match) -> str:
+    # A run with two or more newlines is a paragraph boundary; anything else is a space
+    return '\n\n' if match.group().count('\n') >= 2 else ' '
+
+def iter_text_blocks(file: BinaryIO, block_size: int = 64 * 1024,
+                     max_bytes: Optional[int] = None) -> Iterator[str]:
+    """
+    Reads a binary file in blocks and decodes UTF-8 incrementally.
+    Raises ValueError for oversized, non-UTF-8 or binary (null byte) content.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    total = 0
+    while True:
+        block = file.read(block_size)
+        final = not block
+        total += len(block)
+        if max_bytes is not None and total > max_bytes:
+            raise ValueError(f"File too large (Max {max_bytes // (1024 * 1024)}MB)")
+        try:
+            text = decoder.decode(block, final=final)
+        except UnicodeDecodeError:
+            raise ValueError("File must be valid UTF-8 text")
+        if '\0' in text:
+            raise ValueError("File contains null bytes (binary file?)")
+        if text:
+            yield text
+        if final:
+            return
+
+def iter_clean_text(blocks: Iterable[str]) -> Iterator[str]:
+    """
+    Streaming clean_text: drops null bytes, collapses whitespace to single spaces
+    but keeps paragraph boundaries as a blank line, so the chunker can split on them.
+    Whitespace at the end of a block is carried over, since the run may continue.
+    """
+    carry = ""
+    started = False
+    for block in blocks:
+        block = carry + block.replace('\0', '')
+        body = block.rstrip()
+        trailing = block[len(body):]
+        # Only the number of newlines (0, 1, 2+) in a pending run matters
+        carry = '\n' * min(trailing.count('\n'), 2) or (' ' if trailing else '')
+
+        if not started:
+            body = body.lstrip()
+            if not body:
+                carry = ""
+                continue
+            started = True
+        if body:
+            yield _WHITESPACE.sub(_collapse, body)
 
 def clean_text(text: str) -> str:
-    """Remove null bytes and normalize whitespace."""
-    text = text.replace('\0', '')
-    return re.sub(r'\s+', ' ', text).strip()
-
-def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> list[str]:
-    """
-    Chunk text with sliding window.
-    Prioritizes splitting on double newlines, then single newlines.
-    """
-    chunks = []
-    start = 0
-    text_len = len(text)
-
-    while start < text_len:
-        end = min(start + chunk_size, text_len)
-        
-        # Try to find a nice break point if we are not at the very end
-        if end < text_len:
-            chunk_candidate = text[start:end]
-            last_newline = chunk_candidate.rfind('\n')
-            
-            # Only split if the newline is in the latter half of the chunk
-            # and ensures the chunk is at least bigger than overlap
-            if last_newline != -1 and last_newline > chunk_size * 0.5:
-                end = start + last_newline + 1
-        
-        chunk = text[start:end]
-        chunks.append(chunk)
-        
-        # Calculate step size
-        step = len(chunk) - overlap
-        
-        # CRITICAL FIX: Ensure we always move forward by at least 1 character
-        # If the chunk is smaller than overlap (e.g. at end of file), just move by len(chunk)
-        if step <= 0:
-            start += len(chunk)
+    """Remove null bytes and normalize whitespace, keeping paragraph breaks."""
+    return "".join(iter_clean_text([text]))
+
+# Content-defined chunking: a cut goes after a paragraph break, or after a space
+# where a rolling hash of the preceding _HASH_WINDOW characters has the
+# _CUT_MASK bits clear (about one space in 32). Cut points depend only on
+# nearby text, so an edit moves the boundaries around it and no others.
+_HASH_WINDOW = 16
+CHUNK_OVERLAP = 50  # characters each chunk repeats from the end of the previous one
+_CUT_MASK = 0x1F
+_CHAR_HASHES = np.random.default_rng(0x5EED).integers(0, 2 ** 32, size=256, dtype=np.uint32)
+
+def _cut_points(text: str, context: str) -> List[int]:
+    """
+    Offsets in `text` right after each content-defined cut point. `context` is the
+    text preceding it (its last _HASH_WINDOW - 1 characters are used).
+    """
+    context = context[-(_HASH_WINDOW - 1):]
+    pad = _HASH_WINDOW - 1 - len(context)
+    chars = np.concatenate([
+        np.zeros(pad, dtype=np.uint32),
+        np.frombuffer((context + text).encode("utf-32-le"), dtype=np.uint32)
+    ])
+    values = _CHAR_HASHES[chars & 0xFF]
+
+    # Only spaces and newlines can be cut points, so the hash is only computed there
+    first = _HASH_WINDOW - 1  # index of text[0]
+    current = chars[first:]
+    spaces = np.flatnonzero((current == ord(' ')) | (current == ord('\n'))) + first
+    # Buzhash: XOR of the window's character hashes, each rotated by its distance from the end
+    rolling = values[spaces]
+    for distance in range(1, _HASH_WINDOW):
+        shifted = values[spaces - distance]
+        rolling ^= (shifted << np.uint32(distance)) | (shifted >> np.uint32(32 - distance))
+    paragraph = (chars[spaces] == ord('\n')) & (chars[spaces - 1] == ord('\n'))
+    return (spaces[((rolling & _CUT_MASK) == 0) | paragraph] - first + 1).tolist()
+
+def iter_chunks(pieces: Iterable[str], chunk_size: int = 500, overlap: int = CHUNK_OVERLAP) -> Iterator[str]:
+    """
+    Content-defined chunker over a stream of text pieces. Each chunk ends at the
+    first cut point (see _cut_points) at least 70% of chunk_size past the previous
+    one, or at the last space that keeps it within chunk_size, and starts
+    with the last `overlap` characters of the previous chunk. Re-chunking an edited
+    text therefore reproduces every chunk away from the edit.
+    Only about one window of text is buffered at a time.
+    """
+    min_size = chunk_size * 7 // 10  # close to the fixed-window chunk count
+    max_size = chunk_size - overlap  # new text per chunk, so the overlap fits too
+    buffer = ""
+    cuts: List[int] = []  # cut points in buffer coordinates
+    cut = 0  # where the previous chunk's new text ended
+    first = True
+    pieces = iter(pieces)
+    exhausted = False
+
+    while True:
+        # A chunk can only end before the window's end once we know text continues past it
+        while not exhausted and len(buffer) - cut <= max_size:
+            piece = next(pieces, None)
+            if piece is None:
+                exhausted = True
+            else:
+                # Drop consumed text (all but the overlap) so the buffer stays about one window long
+                base = 0 if first else max(cut - overlap, 0)
+                cuts = [c - base for c in cuts[bisect_right(cuts, cut):]]
+                cuts.extend(c + len(buffer) - base for c in _cut_points(piece, buffer))
+                buffer = buffer[base:] + piece
+                cut -= base
+
+        if cut >= len(buffer):
+            return
+
+        if len(buffer) - cut <= max_size:
+            end = len(buffer)
         else:
-            start += step
-            
-    return chunks
+            i = bisect_left(cuts, cut + min_size)
+            if i < len(cuts) and cuts[i] <= cut + max_size:
+                end = cuts[i]
+            else:
+                space = buffer.rfind(' ', cut + min_size, cut + max_size)
+                end = space + 1 if space != -1 else cut + max_size
+
+        yield buffer[0 if first else max(cut - overlap, 0):end]
+        first = False
+        cut = end
+
+def chunk_text(text: str, chunk_size: int = 500, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """
+    Chunk text at content-defined boundaries, preferring paragraph breaks;
+    consecutive chunks share `overlap` characters.
+    """
+    return list(iter_chunks([text], chunk_size, overlap))
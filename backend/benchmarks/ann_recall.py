@@ -0,0 +1,81 @@
+"""
+Recall@k and latency of the IVF index against exact search on a synthetic corpus.
+
+Usage (from backend/):
+    python -m benchmarks.ann_recall --rows 20000 --dim 768 --nprobe 1 4 8 16 32
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+from app.services.ann import IVFIndex, recall_at_k
+
+def synthetic_corpus(rows: int, dim: int, latent_dim: int, seed: int = 0) -> np.ndarray:
+    """
+    Unit vectors on a low-dimensional subspace plus noise. Real embeddings have a
+    small intrinsic dimension too; pure Gaussian noise would make every method look bad.
+    """
+    projection = np.random.default_rng(42).normal(size=(latent_dim, dim))
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(rows, latent_dim)) @ projection + rng.normal(scale=0.5, size=(rows, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+def exact_top_k(matrix: np.ndarray, query: np.ndarray, k: int) -> np.ndarray:
+    scores = matrix @ query
+    return np.argpartition(-scores, k - 1)[:k]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--latent-dim", type=int, default=32)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    matrix = synthetic_corpus(args.rows, args.dim, args.latent_dim)
+    # Fresh draws from the same distribution, so queries are near but not equal to stored rows
+    queries = synthetic_corpus(args.queries, args.dim, args.latent_dim, seed=1)
+
+    start = time.perf_counter()
+    index = IVFIndex(n_lists=int(np.sqrt(args.rows)))
+    index.train(matrix)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact = [exact_top_k(matrix, q, args.k) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / args.queries
+
+    report = {
+        "rows": args.rows,
+        "dim": args.dim,
+        "k": args.k,
+        "n_lists": index.n_lists,
+        "build_seconds": round(build_seconds, 3),
+        "exact_ms_per_query": round(exact_ms, 3),
+        "ivf": []
+    }
+    for n_probe in args.nprobe:
+        start = time.perf_counter()
+        approximate = []
+        scanned = 0
+        for q in queries:
+            rows = index.candidates(q, n_probe)
+            scanned += len(rows)
+            top = np.argpartition(-(matrix[rows] @ q), min(args.k, len(rows)) - 1)[:args.k]
+            approximate.append(rows[top])
+        ivf_ms = (time.perf_counter() - start) * 1000 / args.queries
+        report["ivf"].append({
+            "n_probe": n_probe,
+            "recall_at_k": round(recall_at_k(exact, approximate), 4),
+            "ms_per_query": round(ivf_ms, 3),
+            "fraction_scanned": round(scanned / (args.queries * args.rows), 4)
+        })
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
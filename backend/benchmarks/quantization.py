@@ -0,0 +1,59 @@
+"""
+Memory per chunk and recall@k for each VECTOR_ENCODING, with and without exact rescoring.
+
+Usage (from backend/):
+    python -m benchmarks.quantization --rows 10000 --dim 3072
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+from app.services.ann import recall_at_k
+from app.services.quantization import ENCODINGS, approximate_scores, bytes_per_vector, encode, normalize
+from benchmarks.ann_recall import synthetic_corpus
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--latent-dim", type=int, default=32)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    args = parser.parse_args()
+
+    raw = synthetic_corpus(args.rows, args.dim, args.latent_dim)
+    queries = synthetic_corpus(args.queries, args.dim, args.latent_dim, seed=1)
+    unit = normalize(raw)
+    exact = [top_k(unit @ q, args.k) for q in queries]
+
+    report = {"rows": args.rows, "dim": args.dim, "k": args.k, "encodings": []}
+    for encoding in ENCODINGS:
+        codes, scales = encode(unit, encoding)
+
+        start = time.perf_counter()
+        first_pass, rescored = [], []
+        for q in queries:
+            scores = approximate_scores(codes, scales, q)
+            first_pass.append(top_k(scores, args.k))
+            shortlist = top_k(scores, args.k * args.rescore_factor)
+            rescored.append(shortlist[top_k(unit[shortlist] @ q, args.k)])
+        ms = (time.perf_counter() - start) * 1000 / args.queries
+
+        report["encodings"].append({
+            "encoding": encoding,
+            "bytes_per_chunk": bytes_per_vector(args.dim, encoding),
+            "recall_at_k_first_pass": round(recall_at_k(exact, first_pass), 4),
+            "recall_at_k_rescored": round(recall_at_k(exact, rescored), 4),
+            "ms_per_query": round(ms, 3)
+        })
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
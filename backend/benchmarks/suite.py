@@ -0,0 +1,316 @@
+"""
+Offline benchmark suite for the ingestion and query paths. Gemini is replaced by
+a deterministic local stand-in with configurable latency, so runs need no API key
+or network and are comparable with each other.
+
+Measures chunk_text throughput, upload chunks/s through the ingestion queue,
+search p50/p99 (vector, lexical, hybrid) as chunks and sessions grow, commit time,
+cold start and page-in time of the store, end-to-end /query latency, and RSS.
+
+Usage (from backend/):
+    python -m benchmarks.suite --output baseline.json
+    python -m benchmarks.suite --output current.json --baseline baseline.json
+
+With --baseline, every metric is compared against the earlier run and the exit
+status is 1 if any regressed by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.ann_recall import synthetic_corpus
+
+class LocalGemini:
+    """
+    Stand-in for genai.Client. Embeddings are sums of per-token random vectors, so
+    texts sharing words land close together; answers echo the question. Every call
+    sleeps for the configured latency first.
+    """
+    def __init__(self, dim: int, embed_latency: float, generate_latency: float):
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.generate_latency = generate_latency
+        self.token_vectors: Dict[str, np.ndarray] = {}
+        self.aio = SimpleNamespace(models=self)
+
+    def embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in text.lower().split():
+            if token not in self.token_vectors:
+                rng = np.random.default_rng(zlib.crc32(token.encode("utf-8")))
+                self.token_vectors[token] = rng.normal(size=self.dim).astype(np.float32)
+            vector += self.token_vectors[token]
+        return vector.tolist()
+
+    async def embed_content(self, model, contents, config=None):
+        await asyncio.sleep(self.embed_latency)
+        if isinstance(contents, str):
+            contents = [contents]
+        dimension = getattr(config, "output_dimensionality", None) if config else None
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=self.embed(text)[:dimension]) for text in contents])
+
+    async def generate_content(self, model, contents, config=None):
+        await asyncio.sleep(self.generate_latency)
+        return SimpleNamespace(text=f"Answer to: {contents[-200:]}")
+
+    async def generate_content_stream(self, model, contents, config=None):
+        async def chunks():
+            for word in f"Answer to: {contents[-200:]}".split():
+                await asyncio.sleep(self.generate_latency / 20)
+                yield SimpleNamespace(text=word + " ")
+        return chunks()
+
+    async def get(self, model, config=None):
+        return SimpleNamespace(name=model)
+
+def synthetic_text(words: int, seed: int, vocabulary: int = 5000) -> str:
+    """Zipf-distributed pseudo-words in paragraphs of 40-120 words."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, vocabulary + 1)
+    tokens = rng.choice(vocabulary, size=words, p=weights / weights.sum())
+    paragraphs, start = [], 0
+    while start < words:
+        end = start + int(rng.integers(40, 120))
+        paragraphs.append(" ".join(f"w{t}" for t in tokens[start:end]) + ".")
+        start = end
+    return "\n\n".join(paragraphs)
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ms = np.asarray(samples) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 3), "p99_ms": round(float(np.percentile(ms, 99)), 3)}
+
+def rss_mb() -> Optional[float]:
+    """
+    Current resident set size: from /proc, else psutil if installed, else peak RSS
+    from the resource module (Unix only). None where none of them is available.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().rss / (1024 * 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def bench_chunking(args) -> Dict:
+    from app.utils import chunk_text
+
+    text = synthetic_text(args.chunking_words, seed=0)
+    elapsed = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        chunks = chunk_text(text)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return {
+        "mb_per_s": round(len(text) / 1e6 / elapsed, 2),
+        "chunks_per_s": round(len(chunks) / elapsed, 1)
+    }
+
+async def bench_upload(args, root: str) -> Dict:
+    from app.services.jobs import IngestionQueue, IngestionTask
+
+    queue = IngestionQueue(max_queued=args.uploads, workers=args.ingest_workers)
+    tasks = []
+    for i in range(args.uploads):
+        task = IngestionTask(f"upload-{i % args.upload_sessions}", f"doc{i}.txt", os.path.join(root, "uploads"))
+        with open(task.path, "w", encoding="utf-8") as f:
+            f.write(synthetic_text(args.upload_words, seed=100 + i))
+        tasks.append(task)
+
+    queue.start()
+    start = time.perf_counter()
+    for task in tasks:
+        await queue.submit(task)
+    await queue.queue.join()
+    elapsed = time.perf_counter() - start
+    await queue.stop()
+
+    failed = [task.error for task in tasks if task.status != "completed"]
+    if failed:
+        raise RuntimeError(f"Uploads failed: {failed[:3]}")
+    chunks = sum(task.chunks_total for task in tasks)
+    return {"uploads": args.uploads, "chunks": chunks, "chunks_per_s": round(chunks / elapsed, 1)}
+
+def bench_store(args, root: str, gemini: LocalGemini) -> Dict[str, Dict]:
+    """Search latency, commit, cold start and page-in time for each size, keyed "<sessions>x<chunks per session>"."""
+    from app.core.config import get_settings
+    from app.services.storage import SimpleVectorStore
+
+    settings = get_settings()
+    results = {}
+    for sessions in args.sessions:
+        for total in args.chunks:
+            settings.STORAGE_DIR = os.path.join(root, f"store-{sessions}-{total}")
+            store = SimpleVectorStore()
+            per_session = max(1, total // sessions)
+            texts = synthetic_text(per_session * 60, seed=sessions).split(" ")
+
+            start = time.perf_counter()
+            for s in range(sessions):
+                vectors = synthetic_corpus(per_session, args.dim, latent_dim=32, seed=s)
+                chunks = [" ".join(texts[i * 60:(i + 1) * 60]) for i in range(per_session)]
+                store.add_many(chunks, vectors, f"doc{s}.txt", f"session-{s}")
+            commit_s = time.perf_counter() - start
+
+            rng = np.random.default_rng(7)
+            queries = []
+            for _ in range(args.queries):
+                words = rng.choice(texts, size=6)
+                queries.append((f"session-{rng.integers(sessions)}", " ".join(words), gemini.embed(" ".join(words))))
+
+            entry = {"commit_s": round(commit_s, 3)}
+            for mode in ("vector", "lexical", "hybrid"):
+                samples = []
+                for session_id, question, vector in queries:
+                    start = time.perf_counter()
+                    if mode == "vector":
+                        store.search(vector, session_id, k=args.k)
+                    elif mode == "lexical":
+                        store.lexical_search(question, session_id, k=args.k)
+                    else:
+                        store.hybrid_search(question, vector, session_id, k=args.k)
+                    samples.append(time.perf_counter() - start)
+                entry[f"search_{mode}"] = percentiles(samples)
+
+            del store
+            start = time.perf_counter()
+            store = SimpleVectorStore()
+            entry["open_s"] = round(time.perf_counter() - start, 3)
+            # Sessions page in on first use; load_s is the cold start plus paging in every one
+            for s in range(sessions):
+                store.shard(f"session-{s}")
+            entry["load_s"] = round(time.perf_counter() - start, 3)
+            entry["rss_mb"] = rss_mb()
+            del store
+            results[f"{sessions}x{per_session}"] = entry
+            print(f"store: {sessions} sessions x {per_session} chunks done", file=sys.stderr)
+    return results
+
+async def bench_query(args) -> Dict:
+    """End-to-end /query (embed, retrieve, generate) against the upload sessions."""
+    from app.api.routes import query_documents
+    from app.models import QueryRequest
+
+    samples = []
+    for i in range(args.queries):
+        request = QueryRequest(question=f"w{i} w{i + 1} w{i + 2} question {i}", k=args.k)
+        start = time.perf_counter()
+        await query_documents(request, session_id=f"upload-{i % args.upload_sessions}")
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+def flatten(report: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    items = report.items() if isinstance(report, dict) else enumerate(report)
+    for key, value in items:
+        name = f"{prefix}{key}"
+        if isinstance(value, (dict, list)):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(current: Dict, baseline: Dict, tolerance: float, noise_floor_ms: float) -> List[str]:
+    """
+    Regressions beyond tolerance; *_per_s is better higher, *_ms/_s/_mb better lower.
+    Timings where both runs are under the noise floor are too small to judge.
+    """
+    regressions = []
+    old = flatten(baseline["results"])
+    for name, value in flatten(current["results"]).items():
+        if name not in old or not old[name]:
+            continue
+        floor = noise_floor_ms if name.endswith("_ms") else noise_floor_ms / 1000 if name.endswith("_s") else 0
+        if max(value, old[name]) < floor:
+            continue
+        change = (value - old[name]) / old[name]
+        if name.endswith("_per_s"):
+            change = -change
+        elif not name.endswith(("_ms", "_s", "_mb")):
+            continue
+        if change > tolerance:
+            regressions.append(f"{name}: {old[name]} -> {value} ({change:+.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier --output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    parser.add_argument("--noise-floor-ms", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=3, help="chunking runs; the best one counts")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--embed-latency-ms", type=float, default=50)
+    parser.add_argument("--generate-latency-ms", type=float, default=300)
+    parser.add_argument("--chunking-words", type=int, default=500000)
+    parser.add_argument("--uploads", type=int, default=8)
+    parser.add_argument("--upload-words", type=int, default=50000)
+    parser.add_argument("--upload-sessions", type=int, default=4)
+    parser.add_argument("--ingest-workers", type=int, default=2)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="qa-bench-")
+    # Settings are read when app modules are first imported
+    os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+    os.environ["STORAGE_DIR"] = os.path.join(root, "store")
+    os.environ["STORAGE_FILE"] = os.path.join(root, "no-legacy-storage.json")
+    os.environ["QUERY_EMBEDDING_CACHE_FILE"] = ""
+
+    import app.services.llm as llm
+    gemini = LocalGemini(args.dim, args.embed_latency_ms / 1000, args.generate_latency_ms / 1000)
+    llm.client = gemini
+
+    results = {"chunking": bench_chunking(args)}
+    results["upload"] = asyncio.run(bench_upload(args, root))
+    results["query"] = asyncio.run(bench_query(args))
+    results["store"] = bench_store(args, root, gemini)
+    results["rss_mb"] = rss_mb()
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "baseline", "tolerance", "noise_floor_ms")
+        },
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.noise_floor_ms)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,38 @@ import React, { useState } from 'react';
 import { useAPI } from '../hooks/useAPI';
 import { Upload, X, FileText, CheckCircle, AlertCircle } from 'lucide-react';
 
+const JOB_POLL_TIMEOUT_MS = 20 * 60 * 1000;
+
 const UploadDropzone = ({ onUploadSuccess }) => {
     const [file, setFile] = useState(null);
     const [uploadStatus, setUploadStatus] = useState('idle'); // idle, uploading, success, error
-    const { post, error } = useAPI();
+    const [uploadError, setUploadError] = useState(null);
+    const { get, post } = useAPI();
+
+    // Uploads are processed in the background; poll the job until it settles
+    const waitForJob = async (jobId) => {
+        const deadline = Date.now() + JOB_POLL_TIMEOUT_MS;
+        while (Date.now() < deadline) {
+            const job = await get(`/api/jobs/${jobId}`);
+            if (job.status === 'completed') return job;
+            if (job.status === 'failed') throw new Error(job.error || 'Upload failed');
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+        throw new Error('Processing is taking too long; check the document list later');
+    };
 
     const handleFileChange = (e) => {
         const selected = e.target.files[0];
         if (selected) {
             // Client-side validation
+            setUploadError(null);
             if (!selected.name.endsWith('.txt')) {
+                setUploadError('Only .txt files are allowed');
                 setUploadStatus('error');
                 return;
             }
             if (selected.size > 10 * 1024 * 1024) { // 10MB
+                setUploadError('File too large (Max 10MB)');
                 setUploadStatus('error');
                 return;
             }
@@ -27,16 +45,18 @@ const UploadDropzone = ({ onUploadSuccess }) => {
     const handleUpload = async () => {
         if (!file) return;
         setUploadStatus('uploading');
+        setUploadError(null);
 
         const formData = new FormData();
         formData.append('file', file);
 
         try {
-            await post('/api/upload', formData, {
+            const job = await post('/api/upload', formData, {
                 headers: {
                     'Content-Type': 'multipart/form-data',
                 },
             });
+            await waitForJob(job.id);
             setUploadStatus('success');
             setFile(null);
             if (onUploadSuccess) onUploadSuccess();
@@ -44,6 +64,8 @@ const UploadDropzone = ({ onUploadSuccess }) => {
             // Reset status after 3s
             setTimeout(() => setUploadStatus('idle'), 3000);
         } catch (err) {
+            // A failed job throws after successful polls, so useAPI's error is empty by then
+            setUploadError(err.response?.data?.detail || err.message);
             setUploadStatus('error');
             console.error("Upload error details:", err);
         }
@@ -101,7 +123,7 @@ const UploadDropzone = ({ onUploadSuccess }) => {
                         {uploadStatus === 'error' && (
                             <div className="flex items-center gap-2 text-red-400 text-xs mt-2">
                                 <AlertCircle className="w-3 h-3" />
-                                <span>{error || "Invalid file"}</span>
+                                <span>{uploadError || "Invalid file"}</span>
                             </div>
                         )}
                     </>